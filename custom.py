@@ -1,10 +1,19 @@
 import os, sys
 import math
+import time as clock
 import Image
-import pycurl, urllib
+import random
+import socket
+import hashlib
+import httplib
+import logging
+import threading
+import urllib, urlparse
+from Queue import LifoQueue, Empty, Full
 from math import log10
 from Image import ANTIALIAS
 from datetime import time
+from collections import OrderedDict
 
 from django.db import models, connection, transaction
 from django.db.models import FileField
@@ -12,7 +21,9 @@ from django.forms import forms
 from django.template.defaultfilters import filesizeformat
 from django.utils.translation import ugettext_lazy as _
 from django.utils import simplejson as json
+from django.utils.importlib import import_module
 from django.core.exceptions import ValidationError
+from django.core.cache import get_cache, InvalidCacheBackendError
 from django.conf import settings
 
 # Online Libraries and Snippets to help Django function
@@ -68,20 +79,140 @@ class ContentTypeRestrictedFileField(FileField):
             pass
         return data
 
-class GoogleLatLng:
+def normalize_address(address):
     """
-    Send an address to Google Geocoder API and get JSON output back.
-    Parse to retrieve latitude and longitude.
-    There is a 24-hour usage limit, currently this is 2500 requests
-    but this could change in the future. Check Google's Terms of Use
-    before employing this technique.
+    Lowercases the address, collapses whitespace and drops empty comma separated parts
+    """
+    parts = [' '.join(p.split()) for p in address.lower().split(',')]
+    return ', '.join(p for p in parts if p)
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache with an optional time to live (in seconds) per entry.
+    Keeps hit and miss counts so that the hit rate can be monitored.
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < clock.time():
+                self.misses += 1
+                return default
+            self.data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, clock.time() + ttl if ttl else None)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return { 'hits':self.hits, 'misses':self.misses, 'size':len(self.data), 'maxsize':self.maxsize }
+
+class GeocodeCache(object):
+    """
+    Two-tier cache of raw Geocoder API responses, keyed by the normalized address and request options.
+    The first tier is an in-process LRUCache. The second is the Django cache named by settings.GEOCODE_CACHE
+    (a database or file based backend), which survives restarts and is shared between processes.
+    Only the raw JSON is stored: whether a water body or a city was asked for only changes how the
+    response is parsed, so the land and water lookups of one address share an entry.
+    """
+    def __init__(self):
+        self.ttl = getattr(settings, 'GEOCODE_CACHE_TTL', 30*24*3600)
+        self.memory = LRUCache(getattr(settings, 'GEOCODE_CACHE_SIZE', 1000), self.ttl)
+        try:
+            self.persistent = get_cache(getattr(settings, 'GEOCODE_CACHE', 'geocode'))
+        except InvalidCacheBackendError:
+            self.persistent = None
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def key(self, address, options):
+        options = sorted((k, v) for k, v in options.items() if k != 'address')
+        raw = normalize_address(address) + '|' + urllib.urlencode(options)
+        if isinstance(raw, unicode):
+            raw = raw.encode('utf-8')
+        return 'geocode:' + hashlib.md5(raw).hexdigest()
+
+    def get(self, address, options):
+        key = self.key(address, options)
+        raw = self.memory.get(key)
+        if raw is None and self.persistent is not None:
+            raw = self.persistent.get(key)
+            if raw is not None:
+                self.persistent_hits += 1
+                self.memory.set(key, raw)
+        if raw is None:
+            self.misses += 1
+            return None
+        return json.loads(raw)
+
+    def set(self, address, options, raw):
+        """
+        raw is the JSON text returned by the Geocoder API. Errors such as OVER_QUERY_LIMIT are not cached.
+        """
+        try:
+            status = json.loads(raw).get('status')
+        except (ValueError, AttributeError):
+            return
+        if status not in ('OK', 'ZERO_RESULTS'):
+            return
+        key = self.key(address, options)
+        self.memory.set(key, raw)
+        if self.persistent is not None:
+            self.persistent.set(key, raw, self.ttl)
+
+    def stats(self):
+        return { 'memory_hits':self.memory.hits, 'persistent_hits':self.persistent_hits,
+                 'misses':self.misses, 'size':len(self.memory.data) }
+
+_geocode_cache = []
+
+def get_geocode_cache():
+    if not _geocode_cache:
+        _geocode_cache.append(GeocodeCache())
+    return _geocode_cache[0]
+
+class BaseGeocoder(object):
+    """
+    Interface for geocoder backends. A backend only has to implement fetch(), returning its answer
+    in the layout of the Google Geocoder API JSON, which is what parseType and parseLocation read
+    and what gets stored in json_response.
     """
     def __init__(self):
         self.lat = 1000.0
         self.lng = 1000.0
         self.results = ""
         self.type = None
-        self.GEOCODE_URL = 'http://maps.googleapis.com/maps/api/geocode/json'
+
+    def fetch(self, address, **kwargs):
+        """
+        Returns a dict with a 'results' list for the address
+        """
+        raise NotImplementedError
 
     def parseType(self, type):
         """
@@ -124,15 +255,278 @@ class GoogleLatLng:
             return r
 
     def requestLatLngJSON(self, address, type=False, sensor='false', **kwargs):
-        kwargs.update({ 'address':address, 'sensor':'false' })
-        url = self.GEOCODE_URL + '?' + urllib.urlencode(kwargs)
-        self.results = json.load(urllib.urlopen(url))
+        self.results = self.fetch(address, **kwargs)
         if not self.results['results']:
             self.type = None
             return False
         else:
             return self.parseType(type)
 
+logger = logging.getLogger('myproject.geocode')
+
+class HTTPPool(object):
+    """
+    Keeps idle keep-alive connections to one host for reuse across calls and threads.
+    Every request is bounded by a connect timeout and a read timeout, and failed attempts
+    (network errors, 5xx and 429 responses) are retried up to `retries` times with exponential backoff.
+    Other responses outside 2xx fail without a retry.
+    Latency of every call, retries included, is recorded for stats().
+    """
+    def __init__(self, url, maxsize=4, connect_timeout=2.0, read_timeout=5.0, retries=2, backoff=0.25):
+        parts = urlparse.urlsplit(url)
+        self.connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+        self.host = parts.netloc
+        self.path = parts.path
+        self.idle = LifoQueue(maxsize)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.calls = self.failures = self.attempts = 0
+        self.total_time = self.max_time = self.last_time = 0.0
+
+    def connection(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            conn = self.connection_class(self.host, timeout=self.connect_timeout)
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+            return conn
+
+    def release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def attempt(self, url):
+        conn = self.connection()
+        try:
+            conn.request('GET', url, headers={ 'Connection':'keep-alive' })
+            response = conn.getresponse()
+            body = response.read()
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        if response.status >= 500 or response.status == 429:
+            raise httplib.HTTPException('HTTP %s from %s' % (response.status, self.host))
+        if not 200 <= response.status < 300:
+            # A client error or a redirect, typically an HTML page from a proxy, which a retry does not change
+            logger.warning('Geocoder request to %s answered HTTP %s', self.host, response.status)
+            return None
+        return body
+
+    def get(self, params):
+        """
+        Returns the body of a 2xx answer to GET path?params, or None when every attempt failed
+        """
+        url = self.path + '?' + urllib.urlencode(params)
+        start = clock.time()
+        body = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                clock.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            with self.lock:
+                self.attempts += 1
+            try:
+                body = self.attempt(url)
+                break
+            except (socket.error, httplib.HTTPException), e:
+                logger.warning('Geocoder request to %s failed (attempt %d): %s', self.host, attempt + 1, e)
+        elapsed = clock.time() - start
+        with self.lock:
+            self.calls += 1
+            self.failures += body is None
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            self.last_time = elapsed
+        return body
+
+    def stats(self):
+        return { 'calls':self.calls, 'attempts':self.attempts, 'failures':self.failures,
+                 'avg_time':self.total_time / self.calls if self.calls else 0.0,
+                 'max_time':self.max_time, 'last_time':self.last_time }
+
+_http_pools = {}
+_http_pools_lock = threading.Lock()
+
+def get_http_pool(url):
+    with _http_pools_lock:
+        if url not in _http_pools:
+            _http_pools[url] = HTTPPool(url, maxsize=getattr(settings, 'GEOCODE_POOL_SIZE', 4),
+                                        connect_timeout=getattr(settings, 'GEOCODE_CONNECT_TIMEOUT', 2.0),
+                                        read_timeout=getattr(settings, 'GEOCODE_READ_TIMEOUT', 5.0),
+                                        retries=getattr(settings, 'GEOCODE_RETRIES', 2))
+        return _http_pools[url]
+
+class GoogleLatLng(BaseGeocoder):
+    """
+    Send an address to Google Geocoder API and get JSON output back.
+    Parse to retrieve latitude and longitude.
+    There is a 24-hour usage limit, currently this is 2500 requests
+    but this could change in the future. Check Google's Terms of Use
+    before employing this technique. Responses are kept in a GeocodeCache
+    so that repeated addresses do not count against the limit, and requests
+    go through a pooled, timeout-bounded HTTPPool.
+    """
+    def __init__(self):
+        super(GoogleLatLng, self).__init__()
+        self.GEOCODE_URL = 'http://maps.googleapis.com/maps/api/geocode/json'
+        self.latency = None # Seconds spent on the last uncached request
+
+    def fetch(self, address, **kwargs):
+        kwargs.update({ 'address':address, 'sensor':'false' })
+        cache = get_geocode_cache()
+        results = cache.get(address, kwargs)
+        if results is None:
+            start = clock.time()
+            raw = get_http_pool(self.GEOCODE_URL).get(kwargs)
+            self.latency = clock.time() - start
+            try:
+                results = json.loads(raw) if raw is not None else None
+            except ValueError:
+                logger.warning('Geocoder answered %r with a body that is not JSON', address)
+                results = None
+            if not isinstance(results, dict) or not isinstance(results.get('results'), list):
+                # The geocoder is unreachable or answered with an error page; answer as if nothing was
+                # found instead of holding up the request
+                return { 'status':'UNKNOWN_ERROR', 'results':[] }
+            cache.set(address, kwargs, raw)
+        return results
+
+class Gazetteer(object):
+    """
+    Place names read from a GeoNames style TSV file (e.g. cities15000.txt or allCountries.txt), indexed
+    by lowercased name. Only populated places (feature class P), hydrographic features (class H),
+    first-order divisions (ADM1) and countries (PCL*) are kept. State names come from an optional
+    admin1CodesASCII.txt file, country names from COUNTRIES_TWO.
+    """
+    def __init__(self, path, admin1_path=None):
+        self.names = {}
+        self.admin1 = {}
+        self.countries = dict((code, unicode(name)) for code, name in COUNTRIES_TWO)
+        if admin1_path:
+            for line in open(admin1_path):
+                row = line.decode('utf-8').rstrip('\n').split('\t')
+                if len(row) >= 2:
+                    self.admin1[row[0]] = row[1]
+        for line in open(path):
+            row = line.decode('utf-8').rstrip('\n').split('\t')
+            if len(row) < 15:
+                continue
+            fclass, fcode = row[6], row[7]
+            if fclass == 'P':
+                kind = 'locality'
+            elif fclass == 'H':
+                kind = 'natural_feature'
+            elif fclass == 'A' and fcode == 'ADM1':
+                kind = 'administrative_area_level_1'
+            elif fclass == 'A' and fcode.startswith('PCL'):
+                kind = 'country'
+            else:
+                continue
+            entry = (row[1], kind, float(row[4]), float(row[5]), row[8], row[10], int(row[14] or 0))
+            for name in set([row[1].lower(), row[2].lower()]):
+                self.names.setdefault(name, []).append(entry)
+        for entries in self.names.values():
+            entries.sort(key=lambda e: -e[6])
+
+    def admin1_name(self, country, code):
+        return self.admin1.get('%s.%s' % (country, code))
+
+    def matches(self, entry, qualifier):
+        name, kind, lat, lng, country, admin1, population = entry
+        state = self.admin1_name(country, admin1) if kind != 'country' else None
+        return (qualifier == country.lower() or qualifier == self.countries.get(country, '').lower() or
+                (state is not None and (qualifier == admin1.lower() or qualifier == state.lower())))
+
+    def component(self, long_name, short_name, type):
+        return { 'long_name':long_name, 'short_name':short_name, 'types':[type, 'political'] }
+
+    def result(self, entry):
+        name, kind, lat, lng, country, admin1, population = entry
+        components = []
+        if kind == 'natural_feature':
+            components.append({ 'long_name':name, 'short_name':name, 'types':[kind] })
+        elif kind == 'locality':
+            components.append(self.component(name, name, kind))
+        elif kind == 'administrative_area_level_1':
+            components.append(self.component(name, admin1, kind))
+        if kind in ('locality', 'natural_feature') and self.admin1_name(country, admin1):
+            components.append(self.component(self.admin1_name(country, admin1), admin1,
+                                             'administrative_area_level_1'))
+        components.append(self.component(self.countries.get(country, name), country, 'country'))
+        return { 'types':[kind, 'political'] if kind != 'natural_feature' else [kind],
+                 'formatted_address':', '.join(c['long_name'] for c in components),
+                 'geometry':{ 'location':{ 'lat':lat, 'lng':lng } },
+                 'address_components':components }
+
+    def search(self, address, limit=5):
+        parts = [' '.join(p.split()) for p in address.lower().split(',')]
+        parts = [p for p in parts if p]
+        if not parts:
+            return []
+        entries = self.names.get(parts[0], [])
+        for qualifier in parts[1:]:
+            entries = [e for e in entries if self.matches(e, qualifier)]
+        return [self.result(e) for e in entries[:limit]]
+
+_gazetteer = []
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+    with _gazetteer_lock:
+        if not _gazetteer:
+            _gazetteer.append(Gazetteer(settings.GAZETTEER_FILE, getattr(settings, 'GAZETTEER_ADMIN1_FILE', None)))
+    return _gazetteer[0]
+
+class GazetteerGeocoder(BaseGeocoder):
+    """
+    Resolves cities, states, countries and bodies of water from the local gazetteer in
+    settings.GAZETTEER_FILE, without any network round trip. Street addresses are not covered.
+    """
+    def fetch(self, address, **kwargs):
+        results = get_gazetteer().search(address)
+        return { 'status':'OK' if results else 'ZERO_RESULTS', 'results':results }
+
+class GeocoderChain(BaseGeocoder):
+    """
+    Asks each backend in turn and keeps the first answer of the requested type
+    """
+    def __init__(self, backends):
+        super(GeocoderChain, self).__init__()
+        self.backends = backends
+
+    def requestLatLngJSON(self, address, type=False, sensor='false', **kwargs):
+        for backend in self.backends:
+            geocoder = backend()
+            found = geocoder.requestLatLngJSON(address, type, sensor, **kwargs)
+            self.lat, self.lng = geocoder.lat, geocoder.lng
+            self.results, self.type = geocoder.results, geocoder.type
+            if found:
+                return True
+        return False
+
+def get_geocoder():
+    """
+    Returns a geocoder for the backends listed in settings.GEOCODER_BACKENDS, by default only Google.
+    For example ('myproject.custom.GazetteerGeocoder', 'myproject.custom.GoogleLatLng') answers from the
+    local gazetteer and falls back on Google for anything it does not know.
+    """
+    backends = []
+    for path in getattr(settings, 'GEOCODER_BACKENDS', ('myproject.custom.GoogleLatLng',)):
+        module, name = path.rsplit('.', 1)
+        backends.append(getattr(import_module(module), name))
+    if len(backends) == 1:
+        return backends[0]()
+    return GeocoderChain(backends)
+
 #adapted from http://www.djangosnippets.org/snippets/494/
 #using UN country and 3 char code list from http://unstats.un.org/unsd/methods/m49/m49alpha.htm
 #correct as of 17th October 2008
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from myproject.customer.models import CustomerCore, ContactInfo, CustomerProfile, PictureGallery, Photograph
+from myproject.customer.models import CustomerCore, ContactInfo, CustomerProfile, PictureGallery, Photograph, GeocodeJob
 
 class CustomerCoreAdmin(admin.ModelAdmin):
     list_display = ('id', '__unicode__')
@@ -9,7 +9,12 @@ class CustomerCoreAdmin(admin.ModelAdmin):
 class ContactInfoAdmin(admin.ModelAdmin):
     list_display = ('__unicode__', 'city', 'state', 'country')
 
+class GeocodeJobAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'status', 'attempts', 'created_on', 'last_error')
+    list_filter = ('status',)
+
 admin.site.register(CustomerCore, CustomerCoreAdmin)
 admin.site.register(ContactInfo, ContactInfoAdmin)
 admin.site.register(CustomerProfile)
 admin.site.register([PictureGallery, Photograph])
+admin.site.register(GeocodeJob, GeocodeJobAdmin)
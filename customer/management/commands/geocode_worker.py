@@ -0,0 +1,70 @@
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from myproject.customer.models import ContactInfo, GeocodeJob
+from myproject.gprofile.models import GuideCore
+
+def run_job(args):
+    """
+    Runs in the worker threads. Refines the coordinates of one contact and records the outcome on its job.
+    """
+    id, max_attempts = args
+    job = GeocodeJob.objects.select_related('contact').get(id=id)
+    try:
+        contact = job.contact
+        contact.clean_location()
+        # update() instead of save(), which would queue the contact again
+        ContactInfo.objects.filter(pk=contact.pk).update(lat=contact.lat, lng=contact.lng)
+        # clean_location() adds the city when it is new, guides saved before that could not be linked to it
+        for guide in GuideCore.objects.filter(person__contact=contact):
+            if guide.link_home():
+                guide.associate_land()
+        GeocodeJob.objects.filter(id=id).update(status=GeocodeJob.DONE, last_error='', updated_on=datetime.now())
+        return True
+    except Exception, e:
+        status = GeocodeJob.FAILED if job.attempts >= max_attempts else GeocodeJob.PENDING
+        GeocodeJob.objects.filter(id=id).update(status=status, last_error=unicode(e)[:300], updated_on=datetime.now())
+        return False
+    finally:
+        connection.close()
+
+class Command(BaseCommand):
+    help = "Processes the queue of deferred contact geocoding jobs with a pool of threads"
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=4, help="Number of jobs geocoded concurrently"),
+        make_option('--batch', type='int', default=50, help="Number of jobs claimed at a time"),
+        make_option('--sleep', type='float', default=5.0, help="Seconds to wait when the queue is empty"),
+        make_option('--max-attempts', type='int', default=3, dest='max_attempts',
+                    help="Attempts before a job is marked as failed"),
+        make_option('--timeout', type='int', default=600,
+                    help="Seconds after which a running job is considered abandoned and requeued"),
+        make_option('--once', action='store_true', default=False, help="Exit once the queue is empty"),
+    )
+
+    def handle(self, *args, **options):
+        pool = ThreadPool(options['workers'])
+        try:
+            while True:
+                # Requeue the jobs of workers that died halfway
+                GeocodeJob.objects.filter(status=GeocodeJob.RUNNING,
+                                          updated_on__lt=datetime.now() - timedelta(seconds=options['timeout'])
+                                          ).update(status=GeocodeJob.PENDING, updated_on=datetime.now())
+                ids = GeocodeJob.objects.filter(status=GeocodeJob.PENDING).values_list('id', flat=True)
+                claimed = [id for id in ids[:options['batch']] if GeocodeJob.objects.claim(id)]
+                if claimed:
+                    start = time.time()
+                    results = pool.map(run_job, [(id, options['max_attempts']) for id in claimed])
+                    self.stdout.write("Geocoded %d contacts (%d failed) in %.1f s\n" %
+                                      (len(results), results.count(False), time.time() - start))
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['sleep'])
+        finally:
+            pool.close()
+            pool.join()
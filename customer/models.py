@@ -1,6 +1,7 @@
 import os, sys
 import Image
 import random
+from datetime import datetime
 from Image import ANTIALIAS
 
 from django.db import models
@@ -13,7 +14,7 @@ from django.core.exceptions import ValidationError, SuspiciousOperation, ObjectD
 from django.contrib.auth.models import User
 from django.template.defaultfilters import slugify
 
-from myproject.custom import digits, GoogleLatLng, resize_image
+from myproject.custom import digits, get_geocoder, resize_image
 from myproject.location.models import BaseLocation, State, Country
 
 # Create your models here.
@@ -50,7 +51,8 @@ class ContactInfo(models.Model):
         if self.state and self.state.country != self.country:
             raise ValidationError("The entered state is not in the country indicated")
         if self.city and self.country:
-            self.clean_location()
+            if not getattr(settings, 'DEFERRED_GEOCODING', False):
+                self.clean_location()
         else:
             raise ValidationError("Please enter a location")
 
@@ -62,7 +64,7 @@ class ContactInfo(models.Model):
                                                             defaults={'city':self.city,
                                                                       'state':self.state,
                                                                       'country':self.country})
-        locQuery = GoogleLatLng()
+        locQuery = get_geocoder()
         if not locQuery.requestLatLngJSON(address_1 + ', ' + address_2 + ', ' + self.city + ', ' + state + ', ' + self.country.abbr):
             if not locQuery.requestLatLngJSON(address_2 + ', ' + self.city + ', ' + state + ', ' + self.country.abbr):
                 self.lat = ncity.lat
@@ -74,11 +76,72 @@ class ContactInfo(models.Model):
             self.lat = locQuery.lat
             self.lng = locQuery.lng
 
+    def address_key(self):
+        return (self.address_line_1, self.address_line_2, self.city, self.state_id, self.country_id)
+
+    def city_location(self):
+        """
+        Falls back on the coordinates of the city, when it is already known, without calling the geocoder
+        """
+        ncity = BaseLocation.objects.filter(city=self.city, state=self.state, country=self.country).exclude(lat=1000.0)
+        for l in ncity[:1]:
+            self.lat = l.lat
+            self.lng = l.lng
+
     def save(self, *args, **kwargs):
+        if getattr(settings, 'DEFERRED_GEOCODING', False):
+            # Street level coordinates are looked up later by the geocode_worker command
+            old = ContactInfo.objects.filter(pk=self.pk).values_list('address_line_1', 'address_line_2', 'city',
+                                                                    'state', 'country') if self.pk else []
+            moved = self.city and self.country and (not old or tuple(old[0]) != self.address_key())
+            if moved:
+                self.lat, self.lng = 1000.0, 1000.0
+                self.city_location()
+            super(ContactInfo, self).save(*args, **kwargs)
+            if moved:
+                GeocodeJob.objects.enqueue(self)
+            return
         if self.city and self.country:
             self.clean_location()
         super(ContactInfo, self).save(*args, **kwargs)
 
+class GeocodeJobManager(models.Manager):
+    def enqueue(self, contact):
+        if not self.filter(contact=contact, status=GeocodeJob.PENDING).exists():
+            self.create(contact=contact)
+
+    def claim(self, id):
+        """
+        Marks a pending job as running. Returns False if another worker got to it first.
+        """
+        return bool(self.filter(id=id, status=GeocodeJob.PENDING).update(status=GeocodeJob.RUNNING,
+                                                                          attempts=F('attempts') + 1,
+                                                                          updated_on=datetime.now()))
+
+class GeocodeJob(models.Model):
+    """
+    Queue of ContactInfo rows waiting for street level coordinates. Saving a contact with
+    settings.DEFERRED_GEOCODING only stores the coordinates of its city and adds a job here.
+    """
+    PENDING, RUNNING, DONE, FAILED = 'P', 'R', 'D', 'F'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    contact = models.ForeignKey(ContactInfo, related_name='GeocodeJobs')
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.CharField(max_length=300, blank=True, default='')
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    objects = GeocodeJobManager()
+
+    class Meta:
+        verbose_name = "Geocoding Job"
+        ordering = ['created_on']
+
+    def __unicode__(self):
+        return 'Geocoding of %s (%s)' % (self.contact_id, self.get_status_display())
+
 class CustomerCore(models.Model):
     first_name = models.CharField(max_length=30)
     middle_name = models.CharField(max_length=30, blank=True, null=True)
@@ -132,6 +195,17 @@ class CustomerProfile(models.Model):
         else:
             return u'Orphan Profile No. %s' % self.id
 
+    @property
+    def profile_pic(self):
+        """
+        The profile picture of the first gallery that has one. Reads the prefetched galleries when the
+        guide was loaded with GuideCore.objects.for_display().
+        """
+        for gallery in self.Galleries.all():
+            if gallery.profile_pic_id:
+                return gallery.profile_pic
+        return None
+
     def save(self, *args, **kwargs):
         #        if self.invites_sent < self.invites_accepted:
         #    raise SuspiciousOperation
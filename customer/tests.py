@@ -5,8 +5,15 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from django.contrib.auth.models import User
 from django.test import TestCase
 
+from myproject.custom import BaseGeocoder
+from myproject.customer.management.commands.geocode_worker import run_job
+from myproject.customer.models import ContactInfo, CustomerCore, GeocodeJob
+from myproject.gprofile.models import GuideCore
+from myproject.location.models import BaseLocation, Country, State
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +21,39 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class AustinGeocoder(BaseGeocoder):
+    """
+    Answers every address with the city of Austin, TX
+    """
+    def fetch(self, address, **kwargs):
+        components = [{ 'long_name':'Austin', 'short_name':'Austin', 'types':['locality', 'political'] },
+                      { 'long_name':'Texas', 'short_name':'TX', 'types':['administrative_area_level_1', 'political'] },
+                      { 'long_name':'United States', 'short_name':'US', 'types':['country', 'political'] }]
+        return { 'status':'OK', 'results':[{ 'types':['locality', 'political'], 'address_components':components,
+                                             'geometry':{ 'location':{ 'lat':30.27, 'lng':-97.74 } } }] }
+
+class DeferredGeocodingTest(TestCase):
+    def setUp(self):
+        self.country = Country.objects.create(abbr='US', name='United States')
+        self.state = State.objects.create(country=self.country, name='Texas', key='TX')
+
+    def test_guide_in_new_city(self):
+        """
+        A guide whose city is not known yet is saved without a home, and linked to it once the
+        geocode_worker command has looked it up
+        """
+        with self.settings(DEFERRED_GEOCODING=True, GEOCODER_BACKENDS=('myproject.customer.tests.AustinGeocoder',)):
+            user = User.objects.create(username='guide', email='guide@example.com')
+            contact = CustomerCore.objects.get(user=user).contact
+            contact.city, contact.state, contact.country = 'Austin', self.state, self.country
+            contact.save()
+            self.assertFalse(BaseLocation.objects.exists())
+            guide = GuideCore(person=CustomerCore.objects.get(user=user))
+            guide.save()
+            self.assertEqual(list(guide.locations.all()), [])
+            job = GeocodeJob.objects.get(contact=contact)
+            self.assertTrue(run_job((job.id, 3)))
+        self.assertEqual(GeocodeJob.objects.get(id=job.id).status, GeocodeJob.DONE)
+        self.assertEqual(ContactInfo.objects.filter(id=contact.id, lat=30.27, lng=-97.74).count(), 1)
+        self.assertEqual([l.city for l in GuideCore.objects.get(id=guide.id).locations.all()], ['Austin'])
@@ -4,8 +4,7 @@ from myproject.fishing.models import LureBrand, RodBrand, ReelBrand, LineBrand,
 from myproject.fishing.models import GuideBoat, EngineBrand, GuideEngine
 
 def update_locations(modeladmin, request, queryset):
-    for obj in queryset:
-        obj.associate_locations()
+    GeoRelations.custom.link_waters(queryset)
 update_locations.short_description = "Reassociate locations"
 
 class WaterBodyAdmin(admin.ModelAdmin):
@@ -0,0 +1,196 @@
+import time
+import hashlib
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from myproject.custom import LRUCache
+from myproject.location.models import BaseLocation, State, Country
+from myproject.fishing.models import WaterBody, Fish, FishingType
+
+# In-process prefix indexes behind the XMLlocation, XMLfish and XMLmethod autocomplete views.
+# Each index keeps one sorted array of (key, rank, display, ident) entries per rank, so the completions of
+# a prefix are one contiguous slice of each array, found with bisect. Reading the slices best rank first
+# yields the completions in result order, and a search stops as soon as it has enough of them. Indexes are built on first use, patched by the model signals of
+# this process and rebuilt once they are older than settings.AUTOCOMPLETE_MAX_AGE seconds.
+# Rendered responses are kept per prefix in an LRU cache; the version of the index is part of the
+# key, so any change to an index retires its cached responses.
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+_responses = LRUCache(getattr(settings, 'AUTOCOMPLETE_CACHE_SIZE', 5000))
+
+def normalize(text):
+    return u' '.join((text or u'').lower().split())
+
+def result_limit():
+    return getattr(settings, 'AUTOCOMPLETE_LIMIT', 20)
+
+class PrefixIndex(object):
+    def __init__(self, sources):
+        """
+        sources is a sequence of (model, rows, related) where rows(obj) returns the (key, rank, display)
+        completions of obj and related are the select_related fields rows needs
+        """
+        self.sources = sources
+        self.lock = threading.RLock()
+        self.built_on = None
+        self.version = 0
+        self.tiers, self.idents = {}, {}
+
+    def build(self):
+        entries, idents = [], {}
+        for model, rows, related in self.sources:
+            objs = model.objects.select_related(*related) if related else model.objects.all()
+            for obj in objs.iterator():
+                ident = (model.__name__, obj.pk)
+                idents[ident] = [(normalize(key), rank, display, ident) for key, rank, display in rows(obj) if normalize(key)]
+                entries.extend(idents[ident])
+        entries.sort()
+        tiers = {}
+        for entry in entries:
+            keys, ranked = tiers.setdefault(entry[1], ([], []))
+            keys.append(entry[0])
+            ranked.append(entry)
+        with self.lock:
+            self.tiers, self.idents = tiers, idents
+            self.built_on = time.time()
+            self.version += 1
+
+    def is_stale(self):
+        max_age = getattr(settings, 'AUTOCOMPLETE_MAX_AGE', 3600)
+        return self.built_on is None or (max_age and time.time() - self.built_on > max_age)
+
+    def remove(self, ident):
+        with self.lock:
+            self.version += 1
+            for entry in self.idents.pop(ident, []):
+                keys, entries = self.tiers.get(entry[1], ([], []))
+                i = bisect_left(entries, entry)
+                if i < len(entries) and entries[i] == entry:
+                    del entries[i]
+                    del keys[i]
+
+    def update(self, obj, rows):
+        ident = (obj.__class__.__name__, obj.pk)
+        new = [(normalize(key), rank, display, ident) for key, rank, display in rows(obj) if normalize(key)]
+        with self.lock:
+            self.remove(ident)
+            for entry in new:
+                keys, entries = self.tiers.setdefault(entry[1], ([], []))
+                i = bisect_left(entries, entry)
+                entries.insert(i, entry)
+                keys.insert(i, entry[0])
+            self.idents[ident] = new
+
+    def search(self, prefix, limit=None):
+        """
+        Returns at most limit distinct completions of prefix, best ranked first, then alphabetically
+        """
+        prefix = normalize(prefix)
+        limit = min(limit or result_limit(), result_limit())
+        if not prefix:
+            return []
+        found, seen = [], set()
+        with self.lock:
+            for rank in sorted(self.tiers):
+                keys, entries = self.tiers[rank]
+                i = bisect_left(keys, prefix)
+                while len(found) < limit and i < len(keys) and keys[i].startswith(prefix):
+                    display = entries[i][2]
+                    if display not in seen:
+                        seen.add(display)
+                        found.append(display)
+                    i += 1
+        return found
+
+def city_rows(loc):
+    parts = [loc.city]
+    if loc.state:
+        parts.append(loc.state.key)
+    if loc.country:
+        parts.append(loc.country.abbr)
+    return [(loc.city, 0, u', '.join(parts))]
+
+def state_rows(state):
+    display = u'%s, %s' % (state.name, state.country.abbr)
+    return [(state.name, 1, display), (state.key, 1, display)]
+
+def country_rows(country):
+    return [(country.name, 2, country.name), (country.abbr, 2, country.name)]
+
+def water_rows(water):
+    return [(water.name, 3, water.name)]
+
+def fish_rows(fish):
+    names = (fish.name, fish.alternate_name_1, fish.alternate_name_2, fish.alternate_name_3)
+    return [(fish.type, 1, fish.name)] + [(name, 0, fish.name) for name in names if name]
+
+def method_rows(method):
+    return [(method.method, 0, method.method)]
+
+SOURCES = {
+    'location': ((BaseLocation, city_rows, ('state', 'country')), (State, state_rows, ('country',)),
+                 (Country, country_rows, ()), (WaterBody, water_rows, ())),
+    'fish': ((Fish, fish_rows, ()),),
+    'method': ((FishingType, method_rows, ()),),
+}
+
+def get_index(name):
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            index = _indexes[name] = PrefixIndex(SOURCES[name])
+    with index.lock:
+        if index.is_stale():
+            index.build()
+    return index
+
+def complete(name, prefix, limit=None):
+    return get_index(name).search(prefix, limit)
+
+def render(name, prefix, separator, limit=None):
+    """
+    Returns (body, etag) of the response listing the completions of prefix, each followed by separator
+    """
+    index = get_index(name)
+    key = (name, index.version, normalize(prefix), min(limit or result_limit(), result_limit()), separator)
+    cached = _responses.get(key)
+    if cached is None:
+        body = u''.join(display + separator for display in index.search(prefix, limit))
+        cached = (body, '"%s"' % hashlib.md5(body.encode('utf-8')).hexdigest())
+        _responses.set(key, cached)
+    return cached
+
+def _built(model):
+    for name, sources in SOURCES.items():
+        for source_model, rows, related in sources:
+            index = _indexes.get(name)
+            if source_model is model and index is not None and index.built_on is not None:
+                yield index, rows
+
+def object_saved(sender, instance=None, raw=False, **kwargs):
+    if instance is None or raw:
+        return
+    for index, rows in _built(sender):
+        index.update(instance, rows)
+    # Cities and states show the abbreviations of their state and country
+    if sender in (State, Country):
+        for index, rows in _built(BaseLocation):
+            for loc in BaseLocation.objects.filter(**{sender.__name__.lower(): instance}).select_related('state', 'country'):
+                index.update(loc, rows)
+    if sender is Country:
+        for index, rows in _built(State):
+            for state in State.objects.filter(country=instance).select_related('country'):
+                index.update(state, rows)
+
+def object_deleted(sender, instance=None, **kwargs):
+    if instance is not None:
+        for index, rows in _built(sender):
+            index.remove((sender.__name__, instance.pk))
+
+for model in (BaseLocation, State, Country, WaterBody, Fish, FishingType):
+    post_save.connect(object_saved, sender=model, dispatch_uid='autocomplete_save_%s' % model.__name__)
+    post_delete.connect(object_deleted, sender=model, dispatch_uid='autocomplete_delete_%s' % model.__name__)
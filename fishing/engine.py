@@ -0,0 +1,312 @@
+import math
+import time
+import warnings
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+from myproject.fishing import searchcache, textindex
+from myproject.fishing.searchkeys import locKey, nullsFirst, ordKeys
+from myproject.fishing.models import Fish, FishingType, faq_mask, faq_match
+from myproject.gprofile.models import GuideCore, GuideParty, GuideSearchDoc
+from myproject.location.geo import bounding_box, earth_radius
+from myproject.tdetails.models import BookedDay
+
+# Optional in-memory search engine. Enable with settings.SEARCH_ENGINE = True; requires NumPy.
+# One row per guide is kept as column arrays, so the filters of retQuery become boolean masks and the
+# ordering of ordQuery a lexsort. The results are the same guides in the same order as the SQL path
+# (see EngineParityTest), with one exception: names are compared by code point, as SQLite and binary
+# collations do, where a case insensitive MySQL collation may order differently cased names otherwise.
+# The engine is rebuilt after the engine generation of fishing.searchcache changes, which the saves of the
+# models it keeps a copy of bump, and once it is older than settings.SEARCH_ENGINE_MAX_AGE seconds. Trips and
+# blackouts are not copied: available() reads the booked days on every search. One search rebuilds the engine
+# while the others keep searching the previous build. bench_engine measures it.
+# The generation lives in the default cache, so the engine needs a cache that every process shares, such as
+# memcached. A DummyCache never keeps the generation and is refused; with a per-process LocMemCache the
+# saves of other processes only reach the engine after SEARCH_ENGINE_MAX_AGE, which is fine for a single
+# process but warned about.
+
+_engine = None
+_engine_lock = threading.Lock()
+_building = False
+
+def enabled():
+    return numpy is not None and getattr(settings, 'SEARCH_ENGINE', False)
+
+def check_cache():
+    if isinstance(cache, DummyCache):
+        raise ImproperlyConfigured("SEARCH_ENGINE needs a cache backend that keeps the search generation")
+    if isinstance(cache, LocMemCache):
+        warnings.warn("SEARCH_ENGINE with a per-process cache: other processes' saves are only seen after "
+                      "SEARCH_ENGINE_MAX_AGE seconds", RuntimeWarning)
+
+def _float(values):
+    return numpy.array([float(v) if v is not None else numpy.nan for v in values], dtype=numpy.float64)
+
+def _ranks(values):
+    """
+    Integer ranks of strings, equal strings sharing a rank, for use as a sort key
+    """
+    distinct = sorted(set(v for v in values if v is not None))
+    rank = dict((v, i) for i, v in enumerate(distinct))
+    return _float([rank.get(v) for v in values])
+
+def _codes(values):
+    """
+    Integer codes of strings, -1 for None, and the code of each string, so that they compare as numbers
+    """
+    codes = dict((v, i) for i, v in enumerate(sorted(set(v for v in values if v is not None))))
+    return numpy.array([codes.get(v, -1) for v in values], dtype=numpy.int64), codes
+
+class GuideEngine(object):
+    def __init__(self):
+        self.built_on = None
+        self.generation = None
+
+    def build(self):
+        generation = searchcache.engine_generation()
+        guides = list(GuideCore.objects.order_by('id').values_list(
+            'id', 'full_day_price', 'experience', 'is_new', 'profile__num_recommends', 'person__first_name',
+            'person__last_name'))
+        self.ids = numpy.array([g[0] for g in guides], dtype=numpy.int64)
+        self.index = dict((id, i) for i, id in enumerate(self.ids.tolist()))
+        self.is_new = numpy.array([g[3] for g in guides], dtype=bool)
+        self.keys = {
+            'id': self.ids.astype(numpy.float64),
+            'full_day_price': _float([g[1] for g in guides]),
+            'experience': _float([g[2] for g in guides]),
+            'profile__num_recommends': _float([g[4] for g in guides]),
+            'person__first_name': _ranks([g[5] for g in guides]),
+            'person__last_name': _ranks([g[6] for g in guides]),
+        }
+        avg_party = dict(GuideParty.objects.values_list('guide', 'avg_party'))
+        self.keys['PartyModel__avg_party'] = _float([avg_party.get(id) for id in self.ids.tolist()])
+
+        # Filter columns come from the search documents, like the SQL filters; NaN where there is none
+        columns = ('search_price', 'min_boat', 'max_boat', 'min_party', 'max_party', 'faq_flags')
+        docs = dict((row[0], row[1:]) for row in GuideSearchDoc.objects.values_list('guide', *columns))
+        empty = (None,) * len(columns)
+        rows = [docs.get(id, empty) for id in self.ids.tolist()]
+        for i, name in enumerate(columns[:-1]):
+            setattr(self, name, _float([row[i] for row in rows]))
+        self.has_doc = numpy.array([id in docs for id in self.ids.tolist()], dtype=bool)
+        self.has_flags = numpy.array([row[-1] is not None for row in rows], dtype=bool)
+        self.faq_flags = numpy.array([row[-1] or 0 for row in rows], dtype=numpy.int64)
+        self.keys['SearchDoc__max_boat'] = self.max_boat
+
+        self.fish = dict((row[0], row[1:]) for row in Fish.objects.values_list(
+            'id', 'name', 'type', 'alternate_name_1', 'alternate_name_2', 'alternate_name_3', 'water_type'))
+        self.methods = dict(FishingType.objects.values_list('id', 'method'))
+        self.fish_bits = self._bitset('fish', self.fish)
+        self.method_bits = self._bitset('methods', self.methods)
+
+        # Points of the locations and water bodies of each guide, the rows nearQuery searches
+        self.point_guide, lats, lngs, self.point_state, self.point_country = [], [], [], [], []
+        for name in ('locations', 'waterbodies'):
+            field = GuideCore._meta.get_field(name)
+            guide, item = field.m2m_field_name(), field.m2m_reverse_field_name()
+            related = [item + '__lat', item + '__lng']
+            if name == 'locations':
+                related += [item + '__state__key', item + '__country__abbr']
+            for row in field.rel.through.objects.values_list(guide, *related):
+                self.point_guide.append(self.index[row[0]])
+                lats.append(row[1])
+                lngs.append(row[2])
+                self.point_state.append(row[3] if name == 'locations' else None)
+                self.point_country.append(row[4] if name == 'locations' else None)
+        self.point_guide = numpy.array(self.point_guide, dtype=numpy.int64)
+        self.point_lat, self.point_lng = _float(lats), _float(lngs)
+        self.point_state, self.state_codes = _codes(self.point_state)
+        self.point_country, self.country_codes = _codes(self.point_country)
+        # Sorted by latitude, so that near() reads the band of the bounding box as one slice
+        order = numpy.argsort(self.point_lat, kind='mergesort')
+        for name in ('point_guide', 'point_lat', 'point_lng', 'point_state', 'point_country'):
+            setattr(self, name, getattr(self, name)[order])
+        self.generation = generation
+        self.built_on = time.time()
+
+    def _bitset(self, name, items):
+        """
+        One row of 64 bit words per guide, bit i of the row set when the guide has the i-th item
+        """
+        self.positions = getattr(self, 'positions', {})
+        self.positions[name] = dict((id, i) for i, id in enumerate(sorted(items)))
+        words = numpy.zeros((len(self.ids), max(1, (len(items) + 63) // 64)), dtype=numpy.uint64)
+        field = GuideCore._meta.get_field(name)
+        rows = list(field.rel.through.objects.values_list(field.m2m_field_name(), field.m2m_reverse_field_name()))
+        if rows:
+            guides = numpy.array([self.index[g] for g, item in rows], dtype=numpy.int64)
+            bits = numpy.array([self.positions[name][item] for g, item in rows], dtype=numpy.int64)
+            numpy.bitwise_or.at(words, (guides, bits // 64), numpy.left_shift(numpy.uint64(1), (bits % 64).astype(numpy.uint64)))
+        return words
+
+    def is_stale(self):
+        max_age = getattr(settings, 'SEARCH_ENGINE_MAX_AGE', 3600)
+        return self.built_on is None or self.generation != searchcache.engine_generation() or \
+               (max_age and time.time() - self.built_on > max_age)
+
+    def has_any(self, words, name, ids):
+        """
+        Mask of the guides that have at least one of the items with the given ids
+        """
+        query = numpy.zeros(words.shape[1], dtype=numpy.uint64)
+        for id in ids:
+            bit = self.positions[name].get(id)
+            if bit is not None:
+                query[bit // 64] |= numpy.uint64(1) << numpy.uint64(bit % 64)
+        return (words & query).any(axis=1)
+
+    def near(self, lat, lng, rad):
+        """
+        Distance in miles from (lat, lng) to the nearest location or water body of each guide within rad
+        miles, NaN for the guides with none, computed like nearQuery
+        """
+        rad = int(rad)
+        min_lat, max_lat, lng_ranges = bounding_box(lat, lng, rad, True)
+        start = numpy.searchsorted(self.point_lat, min_lat, 'left')
+        end = numpy.searchsorted(self.point_lat, max_lat, 'right')
+        lats, lngs, guides = self.point_lat[start:end], self.point_lng[start:end], self.point_guide[start:end]
+        with numpy.errstate(invalid='ignore'):
+            box = numpy.zeros(len(lats), dtype=bool)
+            for min_lng, max_lng in lng_ranges:
+                box |= (lngs >= min_lng) & (lngs <= max_lng)
+            # Spherical law of cosines, capped at 1 as in location.geo.distance_sql
+            cos = numpy.minimum(1.0, numpy.cos(math.radians(lat)) * numpy.cos(numpy.radians(lats[box])) * \
+                  numpy.cos(numpy.radians(lngs[box]) - math.radians(lng)) + \
+                  numpy.sin(math.radians(lat)) * numpy.sin(numpy.radians(lats[box])))
+            distance = earth_radius(True) * numpy.arccos(cos)
+            hits = distance < rad
+        nearest = numpy.empty(len(self.ids))
+        nearest.fill(numpy.inf)
+        numpy.minimum.at(nearest, guides[box][hits], distance[hits])
+        nearest[numpy.isinf(nearest)] = numpy.nan
+        return nearest
+
+    def region(self, column, codes, key):
+        mask = numpy.zeros(len(self.ids), dtype=bool)
+        if key in codes:
+            mask[self.point_guide[column == codes[key]]] = True
+        return mask
+
+    def containing(self, text, items, fields):
+        """
+        Ids of the items with text in one of the first fields of their row, fisQuery's fallback for text the
+        token index does not know
+        """
+        text = text.lower()
+        return [id for id, row in items.items() if [v for v in row[:fields] if v and text in v.lower()]]
+
+    def search(self, loc, type, day, limit=None, **kwargs):
+        """
+        Ordered ids of the guides that retQuery and ordQuery would return for the location loc of types
+        on day.
+        With limit only the first limit of them are sorted and returned.
+        """
+        keys = self.keys
+        if 'country' in type:
+            mask = self.region(self.point_country, self.country_codes, locKey(loc, type))
+        elif 'administrative_area_level_1' in type:
+            mask = self.region(self.point_state, self.state_codes, locKey(loc, type))
+        else:
+            distance = self.near(loc.lat, loc.lng, kwargs.get('radius', 100))
+            mask = ~numpy.isnan(distance)
+            keys = dict(keys, distance=distance)
+        if mask.any():
+            mask &= self.available(day) & self.filter(**kwargs)
+        order = []
+        for name in reversed(ordKeys(kwargs.get('ordering'), 'distance' in keys) + ['id']):
+            desc = name.startswith('-')
+            values = keys[name.lstrip('-')][mask]
+            # NULLs go where the database puts them
+            order.append(numpy.where(numpy.isnan(values), -numpy.inf if nullsFirst(desc) else numpy.inf,
+                                     -values if desc else values))
+        ids = self.ids[mask]
+        if limit is not None and limit < len(ids):
+            # Only the rows that tie with or beat the limit-th value of the first key can make the cut
+            first = order[-1]
+            kept = numpy.flatnonzero(first <= numpy.partition(first, limit - 1)[limit - 1])
+            ids, order = ids[kept], [key[kept] for key in order]
+        return ids[numpy.lexsort(order)][:limit].tolist()
+
+    def available(self, day):
+        """
+        Mask of the guides without a trip or a blackout on day. The booked days are read with one indexed
+        query per search, so bookings show up without a rebuild.
+        """
+        mask = numpy.ones(len(self.ids), dtype=bool)
+        booked = [self.index[id] for id in BookedDay.objects.booked(day).values_list('guide', flat=True) if id in self.index]
+        mask[booked] = False
+        return mask
+
+    def filter(self, **kwargs):
+        """
+        Mask of the guides that pass the fisQuery, groQuery, priQuery and faqQuery filters
+        """
+        mask = numpy.ones(len(self.ids), dtype=bool)
+        fish, watertype, method = kwargs.get('fish'), kwargs.get('watertype'), kwargs.get('method')
+        if fish:
+            ids = textindex.fish_ids(fish)
+            if not ids:
+                ids = self.containing(fish, self.fish, 5)
+                mask &= self.has_doc
+            mask &= self.has_any(self.fish_bits, 'fish', ids)
+        if watertype:
+            ids = [id for id, row in self.fish.items() if row[5] and row[5].lower() == watertype.lower()]
+            mask &= self.has_doc & self.has_any(self.fish_bits, 'fish', ids)
+        if method:
+            ids = textindex.method_ids(method)
+            if not ids:
+                ids = self.containing(method, dict((id, (name,)) for id, name in self.methods.items()), 1)
+                mask &= self.has_doc
+            mask &= self.has_any(self.method_bits, 'methods', ids)
+        with numpy.errstate(invalid='ignore'):
+            boatsize = int(kwargs.get('boatsize', 0))
+            if boatsize:
+                mask &= (self.max_boat >= boatsize) & (self.min_boat <= boatsize)
+            partysize = int(kwargs.get('partysize', 0))
+            if partysize:
+                mask &= (self.max_party >= partysize) & (self.min_party <= partysize)
+            if kwargs.get('price'):
+                maxprice = float(kwargs.get('maxprice', 99999999.99))
+                minprice = float(kwargs.get('minprice', 0))
+                mask &= (self.search_price >= minprice) & (self.search_price <= maxprice)
+        isnew = kwargs.get('isnew')
+        if isnew:
+            mask &= self.is_new == (isnew != 'False')
+        flags, required = faq_mask(**kwargs)
+        if flags:
+            mask &= self.has_flags & faq_match(self.faq_flags, flags, required)
+        return mask
+
+def get_engine():
+    """
+    The current engine. When it is stale the caller builds a new one, while the searches that come in
+    meanwhile are answered from the previous build.
+    """
+    global _engine, _building
+    with _engine_lock:
+        current = _engine
+        if current is not None and (_building or not current.is_stale()):
+            return current
+        _building = True
+    try:
+        fresh = GuideEngine()
+        fresh.build()
+        with _engine_lock:
+            _engine = fresh
+        return fresh
+    finally:
+        with _engine_lock:
+            _building = False
+
+if enabled():
+    check_cache()
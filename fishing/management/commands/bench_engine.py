@@ -0,0 +1,144 @@
+import random
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from myproject.customer.models import ContactInfo, CustomerCore, CustomerProfile
+from myproject.fishing import engine
+from myproject.fishing.models import Fish, FishingType
+from myproject.fishing.views import filterQuery, ordQuery, placeQuery
+from myproject.gprofile.models import GuideCore, GuideParty, GuideProfile, GuideSearchDoc
+from myproject.location.models import BaseLocation, Country, State
+
+TYPES = ('Bass', 'Trout', 'Drum', 'Catfish', 'Perch', 'Pike', 'Salmon', 'Snapper')
+ORDERINGS = (None, 'distance', 'recommend', 'experience', 'alpha', 'party')
+
+def bulk(model, rows):
+    for offset in xrange(0, len(rows), 500):
+        model.objects.bulk_create(rows[offset:offset+500])
+
+class Command(BaseCommand):
+    help = ("Benchmarks the in-memory search engine against the SQL search on synthetic guides, and checks "
+            "that both return the same first page")
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', default=20000, help="Number of synthetic guides to insert"),
+        make_option('--locations', type='int', default=500, help="Number of synthetic locations"),
+        make_option('--queries', type='int', default=50, help="Number of searches to time"),
+        make_option('--seed', type='int', default=0, help="Seed for the random data"),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        if engine.numpy is None:
+            raise CommandError("The search engine needs NumPy")
+        # Everything is rolled back at the end, the synthetic rows never reach the real tables
+        try:
+            rand = random.Random(options['seed'])
+            start = time.time()
+            ids = self.populate(rand, options['count'], options['locations'])
+            self.stdout.write("Inserted %d synthetic guides in %.1f s\n" % (len(ids), time.time() - start))
+            search = engine.GuideEngine()
+            start = time.time()
+            search.build()
+            self.stdout.write("Built the engine in %.2f s\n" % (time.time() - start))
+
+            locations = list(BaseLocation.objects.filter(city__startswith='Benchmark '))
+            day = datetime.today() + timedelta(1)
+            searches = []
+            for i in xrange(options['queries']):
+                kwargs = { 'ordering': rand.choice(ORDERINGS), 'radius': str(rand.choice([25, 100, 250])) }
+                if rand.random() < .5:
+                    kwargs['fish'] = rand.choice(TYPES).lower()
+                type = ['locality', 'political'] if rand.random() < .8 else ['administrative_area_level_1', 'political']
+                searches.append((rand.choice(locations), type, kwargs))
+
+            timings, pages = {}, {}
+            # The first searches also build the token index of fishing.textindex, which is not timed
+            for loc, type, kwargs in searches:
+                search.search(loc, type, day, 50, **kwargs)
+            start = time.time()
+            pages['engine'] = [search.search(loc, type, day, 50, **kwargs) for loc, type, kwargs in searches]
+            timings['engine'] = time.time() - start
+            start = time.time()
+            for loc, type, kwargs in searches:
+                search.available(day)
+            timings['booked'] = time.time() - start
+            start = time.time()
+            pages['sql'] = []
+            for loc, type, kwargs in searches:
+                query = ordQuery(filterQuery(placeQuery(loc, type, **kwargs), day, **kwargs), kwargs.get('ordering'))
+                query = query.order_by(*(list(query.query.order_by) + ['id']))
+                # The distance annotation is only kept, and can only order the rows, when it is selected
+                names = ['id'] + [name for name in query.query.extra if name == 'distance']
+                pages['sql'].append([row[0] for row in query.values_list(*names)[:50]])
+            timings['sql'] = time.time() - start
+
+            if pages['engine'] != pages['sql']:
+                self.stderr.write("The engine returned a different page from SQL for %d searches\n" %
+                                  len([1 for a, b in zip(pages['engine'], pages['sql']) if a != b]))
+            count = float(len(searches))
+            self.stdout.write("%-24s %8.2f ms/query\n" % ('SQL', 1000 * timings['sql'] / count))
+            self.stdout.write("%-24s %8.2f ms/query\n" % ('engine', 1000 * timings['engine'] / count))
+            self.stdout.write("%-24s %8.2f ms/query\n" % ('  of which booked days', 1000 * timings['booked'] / count))
+            self.stdout.write("%-24s %8.2f ms/query\n" % ('  in memory', 1000 * (timings['engine'] - timings['booked']) / count))
+        finally:
+            transaction.rollback()
+
+    def populate(self, rand, count, locations):
+        """
+        Inserts count guides in Benchmark states, each with its own user, contact and profiles, one to three
+        locations, a few fish and methods and a party size, then their search documents. Returns their ids.
+        """
+        country = Country.objects.create(abbr='ZZ', name='Benchmark')
+        states = []
+        for i in xrange(10):
+            states.append(State.objects.create(country=country, name='Benchmark %d' % i, key='B%d' % i))
+        bulk(BaseLocation, [BaseLocation(city='Benchmark %d' % i, state=rand.choice(states), country=country,
+                                         lat=rand.uniform(25.0, 49.0) + i * 1e-9, lng=rand.uniform(-124.0, -67.0))
+                            for i in xrange(locations)])
+        places = list(BaseLocation.objects.filter(country=country).values_list('id', flat=True))
+        last = Fish.objects.aggregate(last=Max('id'))['last'] or 0
+        bulk(Fish, [Fish(name='%s %d' % (rand.choice(TYPES), i), type=rand.choice(TYPES), water_type=rand.choice(['FW', 'SW']))
+                    for i in xrange(40)])
+        fish = list(Fish.objects.filter(id__gt=last).values_list('id', flat=True))
+        bulk(FishingType, [FishingType(method='Benchmark method %d' % i) for i in xrange(10)])
+        methods = list(FishingType.objects.filter(method__startswith='Benchmark ').values_list('id', flat=True))
+
+        names = ['bench-engine-%d' % i for i in xrange(count)]
+        bulk(User, [User(username=name, email=name + '@example.com') for name in names])
+        users = dict(User.objects.filter(username__startswith='bench-engine-').values_list('username', 'id'))
+        bulk(ContactInfo, [ContactInfo(email=name + '@example.com', city='Benchmark', state=states[0], country=country)
+                           for name in names])
+        contacts = dict(ContactInfo.objects.filter(email__endswith='@example.com', country=country).values_list('email', 'id'))
+        last = CustomerProfile.objects.aggregate(last=Max('id'))['last'] or 0
+        bulk(CustomerProfile, [CustomerProfile() for name in names])
+        profiles = list(CustomerProfile.objects.filter(id__gt=last).order_by('id').values_list('id', flat=True))
+        bulk(CustomerCore, [CustomerCore(first_name=rand.choice(['Al', 'Bo', 'Cy', 'Di']), last_name=rand.choice(['Ames', 'Lee', 'Zed']),
+                                         contact_id=contacts[name + '@example.com'], profile_id=profile, user_id=users[name],
+                                         is_guide=True) for name, profile in zip(names, profiles)])
+        people = list(CustomerCore.objects.filter(profile__gt=last).order_by('profile').values_list('id', 'profile'))
+        bulk(GuideProfile, [GuideProfile(cust_profile_id=profile, num_recommends=rand.randint(0, 20)) for person, profile in people])
+        guide_profiles = dict(GuideProfile.objects.filter(cust_profile__gt=last).values_list('cust_profile', 'id'))
+        bulk(GuideCore, [GuideCore(person_id=person, profile_id=guide_profiles[profile], experience=rand.randint(0, 30),
+                                   full_day_price=rand.choice([None, 150, 250, 400]), search_price=rand.choice([None, 150, 250, 400]),
+                                   is_new=rand.random() < .2) for person, profile in people])
+        ids = list(GuideCore.objects.filter(person__profile__gt=last).values_list('id', flat=True))
+
+        for name, items, low, high in (('locations', places, 1, 3), ('fish', fish, 0, 4), ('methods', methods, 0, 2)):
+            field = GuideCore._meta.get_field(name)
+            guide, item = field.m2m_field_name() + '_id', field.m2m_reverse_field_name() + '_id'
+            bulk(field.rel.through, [field.rel.through(**{ guide: id, item: other }) for id in ids
+                                     for other in rand.sample(items, rand.randint(low, high))])
+        parties = []
+        for id in ids:
+            low = rand.randint(1, 4)
+            high = rand.randint(low, 12)
+            parties.append(GuideParty(guide_id=id, min_party=low, max_party=high, avg_party=rand.randint(low, high)))
+        bulk(GuideParty, parties)
+        GuideSearchDoc.objects.refresh(ids)
+        return ids
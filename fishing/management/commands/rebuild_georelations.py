@@ -0,0 +1,21 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject.fishing.models import GeoRelations
+
+class Command(BaseCommand):
+    help = ("Relates every location to the water bodies within --radius of it in one spatial join. "
+            "Existing relations, including the ones added by users, are kept.")
+    option_list = BaseCommand.option_list + (
+        make_option('--radius', type='int', default=100, help="Radius of the neighbourhood"),
+        make_option('--km', action='store_false', dest='use_miles', default=True, help="Radius is in kilometres"),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        start = time.time()
+        added = GeoRelations.custom.rebuild(options['radius'], options['use_miles'])
+        self.stdout.write("Added %d relations in %.1f s\n" % (added, time.time() - start))
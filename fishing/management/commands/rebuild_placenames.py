@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject.fishing.models import PlaceName
+
+class Command(BaseCommand):
+    help = "Rebuilds the place name table that locDetermine resolves searches against"
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        start = time.time()
+        count = PlaceName.objects.rebuild()
+        self.stdout.write("Indexed %d place names in %.1f s\n" % (count, time.time() - start))
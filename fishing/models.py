@@ -7,10 +7,13 @@ from django.conf import settings
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
 from django.db import models, connection, transaction
-from django.db.models.signals import post_save
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver, Signal
 
-from myproject.custom import GoogleLatLng, resize_image
+from myproject.custom import get_geocoder, resize_image, normalize_address
+from myproject.location import spatial
+from myproject.location.geo import earth_radius
 from myproject.location.models import Country, State, BaseLocation, LocationManager
 from myproject.customer.models import CustomerCore
 
@@ -53,20 +56,14 @@ class WaterBody(models.Model):
     def __unicode__(self):
         return self.name
     
-    def associate_locations(self, loc_model=BaseLocation, radius=100, use_miles=True):
-        near = loc_model.neighbours.nearby_locations(self.lat, self.lng, radius, use_miles)
-        for l in near:
-            try:
-                r = GeoRelations.objects.get(location__exact=l, water__exact=self)
-            except:
-                r = GeoRelations(location=l, water=self, verified=True)
-                r.save()
+    def associate_locations(self, radius=100, use_miles=True):
+        GeoRelations.custom.link_water(self, radius, use_miles)
 
     def clean(self, **kwargs):
         mquery = kwargs.get('mquery')
         if self.name or mquery:
             if not mquery:
-                mquery = GoogleLatLng()
+                mquery = get_geocoder()
                 state = self.state.name if self.state else ''
                 country = self.country.abbr if self.country else ''
                 if not mquery.requestLatLngJSON(self.name + ', ' + state + ', ' + country, True):
@@ -120,6 +117,80 @@ class GeoRelationsManager(models.Manager):
         newrel.save()
         return newrel
 
+    def nearby_pairs(self, radius=100, use_miles=True, locations=None, waters=None):
+        """
+        Spatial join of BaseLocation and WaterBody, returning the set of (location id, water id) pairs
+        within radius of each other. locations or waters restrict the join to those ids. The latitude
+        band in the join condition keeps the database on the (lat, lng) index of BaseLocation.
+        """
+        if locations is not None or waters is not None:
+            pairs = set()
+            ids, column = (locations, 'l.id') if locations is not None else (waters, 'w.id')
+            ids = list(ids)
+            for offset in xrange(0, len(ids), 500):
+                pairs.update(self._join(radius, use_miles, column, ids[offset:offset+500]))
+            return pairs
+        return set(self._join(radius, use_miles))
+
+    def _join(self, radius, use_miles, column=None, ids=()):
+        if column and not ids:
+            return []
+        qn = connection.ops.quote_name
+        sql = """SELECT l.id, w.id FROM %s l INNER JOIN %s w ON l.lat BETWEEN w.lat - %%s AND w.lat + %%s
+        WHERE w.lat BETWEEN -90 AND 90 AND (%%s * acos( least( 1, cos( radians(w.lat) ) * cos( radians( l.lat ) ) *
+        cos( radians( l.lng ) - radians(w.lng) ) + sin( radians(w.lat) ) * sin( radians( l.lat ) ) ) ) ) < %%s
+        """ % (qn(BaseLocation._meta.db_table), qn(WaterBody._meta.db_table))
+        band = math.degrees(float(radius) / earth_radius(use_miles))
+        params = [band, band, earth_radius(use_miles), int(radius)]
+        if column:
+            sql += " AND %s IN (%s)" % (column, ', '.join(['%s'] * len(ids)))
+            params.extend(ids)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return [tuple(row) for row in cursor.fetchall()]
+
+    def add_pairs(self, pairs, existing):
+        """
+        Inserts the pairs that are not in existing, in bulk. Returns the number of new relations.
+        """
+        new = [self.model(location_id=l, water_id=w, verified=True) for l, w in set(pairs) - set(existing)]
+        for offset in xrange(0, len(new), 500):
+            self.bulk_create(new[offset:offset+500])
+        return len(new)
+
+    def link_water(self, water, radius=100, use_miles=True):
+        """
+        Relates one water body to the locations around it
+        """
+        near = BaseLocation.neighbours.nearby_ids(water.lat, water.lng, radius, use_miles)
+        existing = self.filter(water=water).values_list('location_id', 'water_id')
+        return self.add_pairs([(l, water.id) for l in near], existing)
+
+    def link_location(self, location, radius=100, use_miles=True):
+        """
+        Relates one location to the water bodies around it
+        """
+        near = WaterBody.neighbours.nearby_ids(location.lat, location.lng, radius, use_miles)
+        existing = self.filter(location=location).values_list('location_id', 'water_id')
+        return self.add_pairs([(location.id, w) for w in near], existing)
+
+    def link_waters(self, waters, radius=100, use_miles=True):
+        ids = [w.id for w in waters]
+        existing = self.filter(water__in=ids).values_list('location_id', 'water_id')
+        return self.add_pairs(self.nearby_pairs(radius, use_miles, waters=ids), existing)
+
+    def link_locations(self, locations, radius=100, use_miles=True):
+        ids = [l.id for l in locations]
+        existing = self.filter(location__in=ids).values_list('location_id', 'water_id')
+        return self.add_pairs(self.nearby_pairs(radius, use_miles, locations=ids), existing)
+
+    def rebuild(self, radius=100, use_miles=True):
+        """
+        Relates every location and water body within radius of each other. Existing relations are
+        kept, including the ones added by users.
+        """
+        return self.add_pairs(self.nearby_pairs(radius, use_miles), self.values_list('location_id', 'water_id'))
+
 class GeoRelations(models.Model):
     location = models.ForeignKey(BaseLocation)
     water = models.ForeignKey(WaterBody)
@@ -140,6 +211,161 @@ class GeoRelations(models.Model):
         verbose_name = "Geographic Relationship"
         unique_together = ('location', 'water')
 
+PLACE_KINDS = ((0, 'City'),
+               (1, 'State'),
+               (2, 'Country'),
+               (3, 'Water Body'))
+
+PLACE_TYPES = {0: ['city',],
+               1: ['administrative_area_level_1',],
+               2: ['country',],
+               3: ['natural_feature',]}
+
+def place_key(name):
+    return normalize_address(name or '').replace(',', '')[:150]
+
+class PlaceNameManager(models.Manager):
+    def _names(self, loc):
+        state, country = loc.state, loc.country
+        return {'state': state, 'country': country,
+                'state_key': place_key(state.key) if state else '', 'state_name': place_key(state.name) if state else '',
+                'country_abbr': place_key(country.abbr) if country else '',
+                'country_name': place_key(country.name) if country else ''}
+
+    def _rows(self, loc=None, water=None):
+        """
+        Unsaved rows for a location, its state and country, or for a water body
+        """
+        obj = loc or water
+        names = self._names(obj)
+        if water:
+            return [self.model(name=place_key(water.name), kind=3, water=water, **names)]
+        rows = [self.model(name=place_key(loc.city), kind=0, location=loc, **names)]
+        if loc.state:
+            rows.append(self.model(name=place_key(loc.state.name), kind=1, location=loc, **names))
+            if place_key(loc.state.key) != place_key(loc.state.name):
+                rows.append(self.model(name=place_key(loc.state.key), kind=1, exact=True, location=loc, **names))
+        if loc.country:
+            rows.append(self.model(name=place_key(loc.country.name), kind=2, location=loc, **names))
+            rows.append(self.model(name=place_key(loc.country.abbr), kind=2, exact=True, location=loc, **names))
+        return [r for r in rows if r.name]
+
+    def index_location(self, loc):
+        """
+        Replaces the city row of loc, and adds rows for its state and country if they have none yet
+        """
+        self.filter(location=loc, kind=0).delete()
+        moved = self.filter(location=loc).filter((Q(kind=1) & ~Q(state=loc.state_id)) | (Q(kind=2) & ~Q(country=loc.country_id)))
+        moved = list(moved.select_related('state', 'country'))
+        if moved:
+            # loc no longer stands for its old state or country, so another of their locations takes over
+            self.filter(id__in=[row.id for row in moved]).delete()
+            for row in moved:
+                if row.kind == 1 and not self.filter(kind=1, state=row.state_id).exists():
+                    self.index_region(state=row.state)
+                elif row.kind == 2 and not self.filter(kind=2, country=row.country_id).exists():
+                    self.index_region(country=row.country)
+        rows = []
+        for row in self._rows(loc=loc):
+            if row.kind == 0 or (row.kind == 1 and not self.filter(kind=1, state=row.state).exists()) or \
+               (row.kind == 2 and not self.filter(kind=2, country=row.country).exists()):
+                rows.append(row)
+        self.bulk_create(rows)
+
+    def index_water(self, water):
+        self.filter(water=water).delete()
+        self.bulk_create(self._rows(water=water))
+
+    def index_region(self, state=None, country=None):
+        """
+        Rebuilds the rows naming state or country, and the qualifiers of the rows inside it
+        """
+        if state:
+            self.filter(kind=1, state=state).delete()
+            self.filter(state=state).update(state_key=place_key(state.key), state_name=place_key(state.name))
+            locs = BaseLocation.objects.filter(state=state)
+        else:
+            self.filter(kind=2, country=country).delete()
+            self.filter(country=country).update(country_abbr=place_key(country.abbr), country_name=place_key(country.name))
+            locs = BaseLocation.objects.filter(country=country)
+        kind = 1 if state else 2
+        for loc in locs.select_related('state', 'country')[:1]:
+            self.bulk_create([row for row in self._rows(loc=loc) if row.kind == kind])
+
+    def rebuild(self):
+        """
+        Rebuilds the whole table. Returns the number of rows.
+        """
+        self.all().delete()
+        rows, regions = [], set()
+        for loc in BaseLocation.objects.select_related('state', 'country').iterator():
+            new = self._rows(loc=loc)
+            rows.extend(row for row in new if row.kind == 0)
+            for kind, region in ((1, loc.state_id), (2, loc.country_id)):
+                if region and (kind, region) not in regions:
+                    regions.add((kind, region))
+                    rows.extend(row for row in new if row.kind == kind)
+        for water in WaterBody.objects.select_related('state', 'country').iterator():
+            rows.extend(self._rows(water=water))
+        for offset in xrange(0, len(rows), 500):
+            self.bulk_create(rows[offset:offset+500])
+        return len(rows)
+
+    def match(self, name):
+        name = place_key(name)
+        return Q(name=name) | Q(name__startswith=name, exact=False)
+
+    def in_state(self, name):
+        name = place_key(name)
+        return Q(state_key=name) | Q(state_name__startswith=name)
+
+    def in_country(self, name):
+        name = place_key(name)
+        return Q(country_abbr=name) | Q(country_name__startswith=name)
+
+    def resolve(self, location):
+        """
+        Returns (obj, types) for "place", "place, region" or "place, state, country" with one query.
+        obj is a BaseLocation for cities, states and countries and a WaterBody for water bodies.
+        Cities win over states, states over countries and countries over water bodies; inside a kind
+        an exact name sorts before the names it is a prefix of.
+        """
+        params = [p.strip() for p in location.split(',')]
+        if len(params) == 1:
+            q = self.match(params[0])
+        elif len(params) == 2:
+            q = (Q(kind=0) & self.match(params[0]) & self.in_state(params[1])) | \
+                (Q(kind=1) & self.match(params[0]) & self.in_country(params[1])) | \
+                (Q(kind=3) & self.match(params[0]) & (self.in_state(params[1]) | self.in_country(params[1])))
+        else:
+            q = Q(kind__in=(0, 3)) & self.match(params[0]) & self.in_state(params[1]) & self.in_country(params[2])
+        found = self.filter(q).select_related('location__state', 'location__country', 'water').order_by('kind', 'name')[:1]
+        for place in found:
+            return (place.water if place.kind == 3 else place.location), PLACE_TYPES[place.kind]
+        return None, None
+
+class PlaceName(models.Model):
+    """
+    Normalized names of cities, states, countries and water bodies, used by locDetermine.
+    Kept in step by the signals at the bottom of this file; rebuild with the rebuild_placenames command.
+    """
+    name = models.CharField(max_length=150, db_index=True)
+    kind = models.PositiveSmallIntegerField(choices=PLACE_KINDS)
+    exact = models.BooleanField(default=False, help_text="Abbreviations only match the whole name")
+    location = models.ForeignKey(BaseLocation, null=True, related_name='PlaceNames')
+    water = models.ForeignKey(WaterBody, null=True, related_name='PlaceNames')
+    state = models.ForeignKey(State, null=True, related_name='PlaceNames')
+    country = models.ForeignKey(Country, null=True, related_name='PlaceNames')
+    state_key = models.CharField(max_length=150, blank=True)
+    state_name = models.CharField(max_length=150, blank=True)
+    country_abbr = models.CharField(max_length=150, blank=True)
+    country_name = models.CharField(max_length=150, blank=True)
+
+    objects = PlaceNameManager()
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.name, self.get_kind_display())
+
 class Fish(models.Model):
     name = models.CharField("Name of Fish", max_length=30)
     type = models.CharField("Type of Fish", max_length=30)
@@ -318,6 +544,32 @@ class GuideBoat(models.Model):
     def __unicode__(self):
         return boat_brand.__unicode__() + ' for ' + guide.__unicode__()
 
+# Boolean fields of GuideFAQ, in the bit order of GuideFAQ.flags
+FAQ_FLAGS = ('child_friendly', 'alcohol_allowed', 'food_provided', 'capture_release', 'state_certified',
+             'CG_certified', 'cert_verify', 'handicap_friendly', 'personal_equipment', 'lost_tackle',
+             'fillet_services', 'taxidermy_services', 'allow_international')
+
+def faq_mask(**kwargs):
+    """
+    Returns (mask, required) for the FAQ_FLAGS named in kwargs. A value of 'False' asks for the flag to be
+    off, any other non-empty value for it to be on. Flags that are not given are left out of the mask.
+    """
+    mask = required = 0
+    for i, name in enumerate(FAQ_FLAGS):
+        value = kwargs.get(name)
+        if value:
+            mask |= 1 << i
+            if value != 'False':
+                required |= 1 << i
+    return mask, required
+
+def faq_match(flags, mask, required):
+    """
+    Whether flags answer the FAQ filter (mask, required). flags may be a single GuideFAQ.flags value or a
+    NumPy integer array of them, which gives a boolean array.
+    """
+    return (flags & mask) == required
+
 class GuideFAQ(models.Model):
     """
     Extras in this model that are not present on the profile page:
@@ -358,6 +610,13 @@ class GuideFAQ(models.Model):
     def __unicode__(self):
         return 'FAQ set for %s' % self.guide.person.full_name
 
+    @property
+    def flags(self):
+        """
+        The FAQ_FLAGS answers packed into an integer, bit i being set when the i-th flag is true
+        """
+        return sum(1 << i for i, name in enumerate(FAQ_FLAGS) if getattr(self, name))
+
     class Meta:
         verbose_name = "Guide FAQ"
 
@@ -457,6 +716,57 @@ def brand_thumbnail(sender, instance=None, max_size=None, **kwargs):
     if instance and max_size:
         resize_image(instance.image, max_size)
 
+spatial.register(WaterBody)
+
+# Only the neighbourhood of the saved object is recomputed, and only when it was created or moved
+@receiver(pre_save, sender=WaterBody)
+@receiver(pre_save, sender=BaseLocation)
+def remember_coordinates(sender, instance=None, raw=False, **kwargs):
+    if instance and not raw and instance.pk:
+        instance._saved_coordinates = tuple(sender.objects.filter(pk=instance.pk).values_list('lat', 'lng')[:1])
+
+def moved(instance, created):
+    return created or getattr(instance, '_saved_coordinates', ()) != ((instance.lat, instance.lng),)
+
+@receiver(post_save, sender=WaterBody)
+def link_water_handler(sender, created=False, instance=None, raw=False, **kwargs):
+    if instance and not raw and -90.0 <= instance.lat <= 90.0 and moved(instance, created):
+        GeoRelations.custom.link_water(instance)
+
+@receiver(post_save, sender=BaseLocation)
+def link_location_handler(sender, created=False, instance=None, raw=False, **kwargs):
+    if instance and not raw and -90.0 <= instance.lat <= 90.0 and moved(instance, created):
+        GeoRelations.custom.link_location(instance)
+
+@receiver(post_save, sender=BaseLocation)
+def place_location_handler(sender, instance=None, raw=False, **kwargs):
+    if instance and not raw:
+        PlaceName.objects.index_location(instance)
+
+@receiver(post_delete, sender=BaseLocation)
+def place_location_delete_handler(sender, instance=None, **kwargs):
+    # The rows of the deleted location are cascaded, so its state and country may need a new representative
+    if instance:
+        if instance.state_id and not PlaceName.objects.filter(kind=1, state=instance.state_id).exists():
+            PlaceName.objects.index_region(state=instance.state)
+        if instance.country_id and not PlaceName.objects.filter(kind=2, country=instance.country_id).exists():
+            PlaceName.objects.index_region(country=instance.country)
+
+@receiver(post_save, sender=WaterBody)
+def place_water_handler(sender, instance=None, raw=False, **kwargs):
+    if instance and not raw:
+        PlaceName.objects.index_water(instance)
+
+@receiver(post_save, sender=State)
+def place_state_handler(sender, instance=None, raw=False, **kwargs):
+    if instance and not raw:
+        PlaceName.objects.index_region(state=instance)
+
+@receiver(post_save, sender=Country)
+def place_country_handler(sender, instance=None, raw=False, **kwargs):
+    if instance and not raw:
+        PlaceName.objects.index_region(country=instance)
+
 @receiver(post_save, sender=EngineBrand)
 def type_thumbnail(sender, created=False, instance=None, **kwargs):
     if instance:
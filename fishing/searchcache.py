@@ -0,0 +1,78 @@
+import time
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from myproject.custom import LRUCache, normalize_address
+
+# Cache of searchDisplay results: the ordered guide ids of a page of a search, keyed by its normalized
+# parameters and page cursor.
+# Entries live in an in-process LRU cache for settings.SEARCH_CACHE_TTL seconds. Every change to the data
+# that searches read bumps a generation stored in the default Django cache, which is part of the key,
+# so the other processes stop serving their entries as well. The in-memory engine of fishing.engine has a
+# generation of its own, bumped only by the models it keeps a copy of, so that bookings and the like do not
+# rebuild it.
+
+PARAMETERS = ('fish', 'watertype', 'method', 'boatsize', 'partysize', 'price', 'maxprice', 'minprice',
+              'isnew', 'child_friendly', 'alcohol_allowed', 'food_provided', 'capture_release',
+              'state_certified', 'CG_certified', 'cert_verify', 'handicap_friendly', 'personal_equipment', 'lost_tackle',
+              'fillet_services', 'taxidermy_services', 'allow_international', 'ordering', 'radius')
+
+GENERATION_KEY = 'search_generation'
+ENGINE_GENERATION_KEY = 'search_engine_generation'
+
+_results = LRUCache(getattr(settings, 'SEARCH_CACHE_SIZE', 1000), getattr(settings, 'SEARCH_CACHE_TTL', 300))
+
+def generation():
+    return cache.get(GENERATION_KEY, 0)
+
+def engine_generation():
+    return cache.get(ENGINE_GENERATION_KEY, 0)
+
+def key(location, day, params, cursor=''):
+    """
+    Key of a page of a search. day is the resolved date, so the default search of tomorrow changes key
+    every day. The generation is read here, so results computed while the data changed are stored under
+    the old one.
+    """
+    options = sorted((name, params[name].strip().lower()) for name in PARAMETERS if params.get(name, '').strip())
+    raw = u'%s|%s|%s|%s' % (normalize_address(location), day.strftime('%Y-%m-%d'),
+                            u'&'.join(u'%s=%s' % option for option in options), cursor or '')
+    return (generation(), hashlib.md5(raw.encode('utf-8')).hexdigest())
+
+def get(search_key):
+    return _results.get(search_key)
+
+def put(search_key, ids):
+    _results.set(search_key, ids)
+
+def invalidate(**kwargs):
+    _results.clear()
+    cache.set(GENERATION_KEY, time.time(), 30*24*3600)
+
+def invalidate_engine(**kwargs):
+    """
+    Drops the cached searches and has the search engine rebuilt on its next search
+    """
+    invalidate()
+    cache.set(ENGINE_GENERATION_KEY, time.time(), 30*24*3600)
+
+def stats():
+    return _results.stats()
+
+def connect(*models, **kwargs):
+    """
+    Drops the cached searches whenever an instance of one of models is saved or deleted. With engine=True,
+    for the models the search engine keeps a copy of, the engine is rebuilt as well.
+    """
+    receiver = invalidate_engine if kwargs.get('engine') else invalidate
+    for model in models:
+        post_save.connect(receiver, sender=model, dispatch_uid='searchcache_save_%s' % model.__name__)
+        post_delete.connect(receiver, sender=model, dispatch_uid='searchcache_delete_%s' % model.__name__)
+
+def connect_m2m(*fields, **kwargs):
+    receiver = invalidate_engine if kwargs.get('engine') else invalidate
+    for field in fields:
+        m2m_changed.connect(receiver, sender=field.rel.through, dispatch_uid='searchcache_m2m_%s_%s' % (field.model.__name__, field.name))
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.db import connection
+
+# Keys of a search shared by the SQL path of fishing.views and the in-memory engine, so that both find and
+# order the guides the same way
+
+def locKey(loc, type):
+    """
+    Country abbreviation or state key of a location returned by locResolve
+    """
+    try:
+        return loc.results['address_components'][0]['short_name']
+    except:
+        return loc.country.abbr if 'country' in type else loc.state.key
+
+def ordKeys(ordering, near=False):
+    """
+    The order_by arguments of a search ordering. Searches around a point, whose guides carry the distance
+    annotation of nearQuery, can be ordered nearest first; that is also their default with
+    settings.SEARCH_NEAREST_FIRST.
+    """
+    sort = ['full_day_price', '-profile__num_recommends', '-experience', 'person__first_name', 'person__last_name', '-PartyModel__avg_party']
+    new_sort = sort
+    if ordering == 'recommend':
+        new_sort = [sort.pop(1)]
+        new_sort.extend(sort)
+    if ordering == 'experience':
+        new_sort = [sort.pop(2)]
+        new_sort.extend(sort)
+    if ordering == 'alpha':
+        new_sort = [sort.pop(3), sort.pop(3)]
+        new_sort.extend(sort)
+    if ordering == 'party' or ordering == 'boat':
+        new_sort = [sort.pop(5)]
+        new_sort.extend(sort)
+        if ordering == 'boat':
+            new_sort.insert(0, '-SearchDoc__max_boat')
+    if near and (ordering == 'distance' or (not ordering and getattr(settings, 'SEARCH_NEAREST_FIRST', True))):
+        new_sort.insert(0, 'distance')
+    return new_sort
+
+def nullsFirst(desc):
+    """
+    Whether the database puts NULLs first when it sorts a column in the given direction. MySQL and SQLite
+    sort NULLs below every value, PostgreSQL and Oracle above.
+    """
+    return desc == (connection.vendor in ('postgresql', 'oracle'))
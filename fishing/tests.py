@@ -5,7 +5,21 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import random
+from datetime import date, datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.template.loader import render_to_string
 from django.test import TestCase
+from django.utils import unittest
+
+from myproject.customer.models import ContactInfo, CustomerCore, PictureGallery, Photograph
+from myproject.fishing import engine, textindex
+from myproject.fishing.models import BoatBrand, Fish, FishingType, GuideBoat, PlaceName, WaterBody, FAQ_FLAGS
+from myproject.fishing.views import datQuery, encodeCursor, guidesById, searchPage
+from myproject.gprofile.models import GuideCore, GuideParty, GuideProfile, GuideSearchDoc
+from myproject.location.models import BaseLocation, Country, State
+from myproject.tdetails.models import BookedDay, GuideBlackout, Trip
 
 
 class SimpleTest(TestCase):
@@ -14,3 +28,251 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class SearchResultsTest(TestCase):
+    def setUp(self):
+        country = Country.objects.create(abbr='US', name='United States')
+        state = State.objects.create(country=country, name='Texas', key='TX')
+        BaseLocation.objects.bulk_create([BaseLocation(city='Austin', state=state, country=country, lat=30.27, lng=-97.74)])
+        fish = [Fish.objects.create(name='Fish %d' % i, type='Bass', water_type='FW') for i in range(3)]
+        self.ids = []
+        for i in range(50):
+            user = User.objects.create(username='guide%d' % i, email='guide%d@example.com' % i)
+            person = CustomerCore.objects.get(user=user)
+            ContactInfo.objects.filter(id=person.contact_id).update(city='Austin', state=state, country=country)
+            guide = GuideCore(person=CustomerCore.objects.get(id=person.id))
+            guide.save()
+            guide.fish.add(*fish)
+            gallery = PictureGallery.objects.get(owner_profile=person.profile)
+            Photograph.objects.bulk_create([Photograph(gallery=gallery, title='Guide', image='photos/%d.jpg' % i,
+                                                       thumb='photos/thumb%d.jpg' % i)])
+            PictureGallery.objects.filter(id=gallery.id).update(profile_pic=Photograph.objects.get(gallery=gallery))
+            self.ids.append(guide.id)
+
+    def test_results_query_count(self):
+        """
+        A page of 50 results renders with one query for the guides, one for their fish, one for their
+        galleries and one for the profile pictures
+        """
+        with self.assertNumQueries(4):
+            html = render_to_string('results.html', { 'guides_list': guidesById(self.ids) })
+        self.assertEqual(html.count('Fish 2'), 50)
+        self.assertEqual(html.count('photos/thumb'), 50)
+
+@unittest.skipIf(engine.numpy is None, "the search engine needs NumPy")
+class EngineParityTest(TestCase):
+    PLACES = ('Austin', 'Tulsa', 'Texas', 'Oklahoma', 'Lake Travis', 'United States')
+
+    def setUp(self):
+        rand = random.Random(7)
+        country = Country.objects.create(abbr='US', name='United States')
+        texas = State.objects.create(country=country, name='Texas', key='TX')
+        oklahoma = State.objects.create(country=country, name='Oklahoma', key='OK')
+        BaseLocation.objects.bulk_create([BaseLocation(city='Austin', state=texas, country=country, lat=30.27, lng=-97.74),
+                                          BaseLocation(city='Waco', state=texas, country=country, lat=31.55, lng=-97.15),
+                                          BaseLocation(city='Tulsa', state=oklahoma, country=country, lat=36.15, lng=-95.99)])
+        WaterBody.objects.bulk_create([WaterBody(name='Lake Travis', state=texas, country=country, lat=30.42, lng=-97.91)])
+        PlaceName.objects.rebuild()
+        cities, waters = list(BaseLocation.objects.all()), list(WaterBody.objects.all())
+        fish = [Fish.objects.create(name=name, type=type, water_type=water) for name, type, water in
+                (('Largemouth Bass', 'Bass', 'FW'), ('Red Drum', 'Drum', 'SW'), ('Catfish', 'Catfish', 'FW'))]
+        methods = [FishingType.objects.create(method=method) for method in ('Fly Fishing', 'Trolling')]
+        for i in range(40):
+            user = User.objects.create(username='guide%d' % i, email='guide%d@example.com' % i,
+                                       first_name=rand.choice(['Al', 'Bo']), last_name=rand.choice(['Ames', 'Zed']))
+            person = CustomerCore.objects.get(user=user)
+            ContactInfo.objects.filter(id=person.contact_id).update(city='Austin', state=texas, country=country)
+            guide = GuideCore(person=CustomerCore.objects.get(id=person.id), experience=rand.randint(0, 3))
+            guide.save()
+            GuideCore.objects.filter(id=guide.id).update(full_day_price=rand.choice([None, 100, 200]),
+                                                         search_price=rand.choice([None, 100, 200]), is_new=rand.random() < .5)
+            GuideProfile.objects.filter(id=guide.profile_id).update(num_recommends=rand.randint(0, 2))
+            guide.locations.add(*rand.sample(cities, rand.randint(0, 2)))
+            guide.waterbodies.add(*rand.sample(waters, rand.randint(0, 1)))
+            guide.fish.add(*rand.sample(fish, rand.randint(0, 2)))
+            guide.methods.add(*rand.sample(methods, rand.randint(0, 1)))
+            faq = guide.FAQ
+            for name in FAQ_FLAGS:
+                setattr(faq, name, rand.random() < .5)
+            faq.save()
+            if rand.random() < .2:
+                tomorrow = date.today() + timedelta(1)
+                GuideBlackout.objects.create(guide=guide, start_date=tomorrow - timedelta(rand.randint(0, 2)),
+                                             end_date=tomorrow + timedelta(rand.randint(0, 2)))
+        GuideSearchDoc.objects.refresh()
+        self.rand = rand
+
+    def search(self, place, enabled, **kwargs):
+        with self.settings(SEARCH_ENGINE=enabled, SEARCH_PAGE_SIZE=1000):
+            return searchPage(place, '', '', **kwargs)[0]
+
+    def test_engine_matches_sql(self):
+        """
+        The engine finds the same guides in the same order as the SQL filters for random searches
+        """
+        rand = self.rand
+        for i in range(100):
+            kwargs = { 'ordering': rand.choice([None, 'distance', 'recommend', 'experience', 'alpha', 'party', 'boat']) }
+            if rand.random() < .3:
+                kwargs['fish'] = rand.choice(['bass', 'drums', 'atfi', 'trout'])
+            if rand.random() < .2:
+                kwargs['watertype'] = rand.choice(['FW', 'SW'])
+            if rand.random() < .2:
+                kwargs['method'] = rand.choice(['fly', 'troll'])
+            if rand.random() < .2:
+                kwargs.update(price='1', minprice='150', maxprice='250')
+            if rand.random() < .2:
+                kwargs['isnew'] = rand.choice(['True', 'False'])
+            if rand.random() < .3:
+                kwargs[rand.choice(FAQ_FLAGS)] = rand.choice(['True', 'False'])
+            if rand.random() < .5:
+                kwargs['radius'] = rand.choice(['10', '100', '500'])
+            place = rand.choice(self.PLACES)
+            self.assertEqual(self.search(place, True, **kwargs), self.search(place, False, **kwargs), (place, kwargs))
+
+    def test_blackouts_hide_guides(self):
+        blacked_out = set(GuideBlackout.objects.values_list('guide', flat=True))
+        for enabled in (True, False):
+            found = self.search('United States', enabled)
+            self.assertEqual(set(found) & blacked_out, set())
+            self.assertEqual(len(found) + len(blacked_out), GuideCore.objects.exclude(locations=None).count())
+
+    def test_trips_hide_guides(self):
+        tomorrow = date.today() + timedelta(1)
+        guide = GuideCore.objects.exclude(Blackouts__isnull=False).exclude(locations=None)[0]
+        customer = CustomerCore.objects.exclude(id=guide.person_id)[0]
+        before = engine.get_engine()
+        Trip(customer=customer, guide=guide, location=BaseLocation.objects.all()[0], num_people=2,
+             trip_start_date=datetime.combine(tomorrow, time(9)), trip_end_date=datetime.combine(tomorrow, time(17))).save()
+        self.assertEqual(CustomerCore.objects.get(id=customer.id).profile.ntrips, 1)
+        self.assertFalse(datQuery(GuideCore.objects.all(), tomorrow).filter(id=guide.id).exists())
+        self.assertTrue(datQuery(GuideCore.objects.all(), tomorrow + timedelta(1)).filter(id=guide.id).exists())
+        current = engine.get_engine()
+        # Bookings are read on every search and do not rebuild the engine
+        self.assertIs(current, before)
+        self.assertFalse(current.available(tomorrow)[current.index[guide.id]])
+        self.assertTrue(current.available(tomorrow + timedelta(1))[current.index[guide.id]])
+        for enabled in (True, False):
+            self.assertNotIn(guide.id, self.search('United States', enabled))
+
+    def test_moved_blackout_frees_guide(self):
+        blackout = GuideBlackout.objects.all()[0]
+        other = GuideCore.objects.exclude(Blackouts__isnull=False).exclude(locations=None)[0]
+        previous, day = blackout.guide_id, blackout.start_date
+        blackout.guide = other
+        blackout.save()
+        booked = set(BookedDay.objects.booked(day).values_list('guide', flat=True))
+        self.assertIn(other.id, booked)
+        self.assertNotIn(previous, booked)
+
+    def test_engine_follows_changes(self):
+        before = self.search('Texas', True)
+        GuideCore.objects.get(id=before[0]).locations.clear()
+        GuideCore.objects.get(id=before[0]).waterbodies.clear()
+        self.assertEqual(self.search('Texas', True), before[1:])
+
+class SearchPagingTest(TestCase):
+    ORDERINGS = (None, 'recommend', 'experience', 'alpha', 'party', 'boat')
+
+    def setUp(self):
+        rand = random.Random(3)
+        country = Country.objects.create(abbr='US', name='United States')
+        texas = State.objects.create(country=country, name='Texas', key='TX')
+        BaseLocation.objects.bulk_create([BaseLocation(city='Austin', state=texas, country=country, lat=30.27, lng=-97.74)])
+        PlaceName.objects.rebuild()
+        brand = BoatBrand.objects.create(brand='Skeeter')
+        for i in range(30):
+            user = User.objects.create(username='guide%d' % i, email='guide%d@example.com' % i,
+                                       first_name=rand.choice(['Al', 'Bo']), last_name=rand.choice(['Ames', 'Zed']))
+            person = CustomerCore.objects.get(user=user)
+            ContactInfo.objects.filter(id=person.contact_id).update(city='Austin', state=texas, country=country)
+            guide = GuideCore(person=CustomerCore.objects.get(id=person.id), experience=rand.randint(0, 2))
+            guide.save()
+            # Few distinct values, and NULLs in the ascending price and the descending party and boat keys
+            GuideCore.objects.filter(id=guide.id).update(full_day_price=rand.choice([None, 100, 200]))
+            GuideProfile.objects.filter(id=guide.profile_id).update(num_recommends=rand.randint(0, 1))
+            if rand.random() < .3:
+                GuideParty.objects.filter(guide=guide).delete()
+            if rand.random() < .5:
+                GuideBoat.objects.create(guide=guide, boat_brand=brand, boat_length=rand.choice([16, 20]))
+        GuideSearchDoc.objects.refresh()
+        self.assertTrue(GuideCore.objects.filter(full_day_price=None).exists())
+        self.assertTrue(GuideCore.objects.filter(PartyModel=None).exists())
+        self.assertTrue(GuideSearchDoc.objects.filter(max_boat=None).exists())
+
+    def pages(self, place, cursor='', size=4, **kwargs):
+        ids = []
+        with self.settings(SEARCH_ENGINE=False, SEARCH_PAGE_SIZE=size):
+            while True:
+                page, cursor = searchPage(place, '', cursor, **kwargs)
+                ids.extend(page)
+                if not cursor:
+                    return ids
+
+    def test_pages_match_full_search(self):
+        """
+        Paging through a search with keyset cursors gives the whole search once, in order, for orderings
+        with NULLs and ties in either direction
+        """
+        for ordering in self.ORDERINGS:
+            full = self.pages('Texas', size=1000, ordering=ordering)
+            self.assertEqual(len(full), 30)
+            for size in (1, 4, 7):
+                self.assertEqual(self.pages('Texas', size=size, ordering=ordering), full, (ordering, size))
+
+    def test_nearest_pages_match_full_search(self):
+        full = self.pages('Austin', size=1000)
+        self.assertEqual(len(full), 30)
+        self.assertEqual(self.pages('Austin', size=4), full)
+
+    def test_bad_cursors_start_over(self):
+        """
+        Stale or crafted cursors give the first page instead of an error
+        """
+        with self.settings(SEARCH_ENGINE=False, SEARCH_PAGE_SIZE=4):
+            first = searchPage('Texas', '', '', ordering='recommend')
+            self.assertEqual(len(first[0]), 4)
+            for cursor in ('garbage', encodeCursor({'a': 1}), encodeCursor([]), encodeCursor([1, 2]),
+                           encodeCursor(['many', 'x', 'y', 'z', 'w', 'v', 'u']), encodeCursor([[1], {}, 3, 4, 5, 6, 7]),
+                           encodeCursor([8])):
+                self.assertEqual(searchPage('Texas', '', cursor, ordering='recommend'), first, cursor)
+            nearest = searchPage('Austin', '', '')
+            for cursor in (encodeCursor([-4]), encodeCursor([True]), encodeCursor(['4']), encodeCursor([None])):
+                self.assertEqual(searchPage('Austin', '', cursor), nearest, cursor)
+
+class TextIndexTest(TestCase):
+    def setUp(self):
+        self.bass = Fish.objects.create(name='Largemouth Bass', type='Bass', water_type='FW')
+        self.walleye = Fish.objects.create(name='Walleye', type='Perch', water_type='FW', alternate_name_1='Pickerel')
+        self.drum = Fish.objects.create(name='Red Drum', type='Drum', water_type='SW', alternate_name_1='Redfish')
+        self.fly = FishingType.objects.create(method='Fly Fishing')
+        self.speed = FishingType.objects.create(method='Speed Trolling')
+
+    def test_stem(self):
+        self.assertEqual(textindex.stem('basses'), 'bass')
+        self.assertEqual(textindex.stem('walleyes'), 'walleye')
+        self.assertEqual(textindex.stem('flies'), 'fly')
+        self.assertEqual(textindex.stem('bass'), 'bass')
+        self.assertEqual(textindex.stem('speed'), 'speed')
+        self.assertEqual(textindex.stem('trolling'), 'trolling')
+
+    def test_tokenize(self):
+        self.assertEqual(textindex.tokenize(u'Largemouth  BASSES, red-drum'), ['largemouth', 'bass', 'red', 'drum'])
+        self.assertEqual(textindex.tokenize(None), [])
+
+    def test_lookup(self):
+        self.assertEqual(textindex.fish_ids('basses'), set([self.bass.id]))
+        self.assertEqual(textindex.fish_ids('red'), set([self.drum.id]))
+        self.assertEqual(textindex.fish_ids('red drum'), set([self.drum.id]))
+        self.assertEqual(textindex.fish_ids('pickerel'), set([self.walleye.id]))
+        self.assertEqual(textindex.fish_ids('waleye'), set([self.walleye.id]))
+        self.assertEqual(textindex.fish_ids('bass drum'), set())
+        self.assertEqual(textindex.fish_ids('  '), None)
+        self.assertEqual(textindex.method_ids('speed'), set([self.speed.id]))
+        self.assertEqual(textindex.method_ids('troll'), set([self.speed.id]))
+        self.assertEqual(textindex.method_ids('fly'), set([self.fly.id]))
+
+    def test_lookup_follows_changes(self):
+        self.assertEqual(textindex.fish_ids('trout'), set())
+        trout = Fish.objects.create(name='Rainbow Trout', type='Trout', water_type='FW')
+        self.assertEqual(textindex.fish_ids('trouts'), set([trout.id]))
@@ -0,0 +1,115 @@
+import re
+import time
+import difflib
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from myproject.fishing.models import Fish, FishingType
+
+# In-process token indexes of fish names and fishing methods, used by fisQuery to turn the text of a search
+# into fish and method ids. Every name is split into lowercased word tokens, optionally stemmed; a search
+# word matches the tokens it is a prefix of, or failing that the tokens that are close to it in spelling.
+# The indexes are rebuilt on the next lookup after a Fish or FishingType is saved or deleted in this
+# process, and once they are older than settings.TEXT_INDEX_MAX_AGE seconds.
+
+FUZZY_CUTOFF = 0.8      # difflib similarity needed for a misspelled word to match
+FUZZY_MATCHES = 3       # Closest tokens taken for a misspelled word
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def stem(word):
+    """
+    Strips plural endings only, so that "basses" and "bass" or "flies" and "fly" share a token. Verb
+    endings are left alone: the prefix match already finds "trolling" from "troll".
+    """
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('ches', 'shes', 'sses', 'xes', 'zes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+def tokenize(text):
+    words = WORD.findall((text or u'').lower())
+    if getattr(settings, 'TEXT_INDEX_STEMMING', True):
+        words = [stem(word) for word in words]
+    return words
+
+class TokenIndex(object):
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.built_on = None
+        self.vocabulary, self.postings = [], {}
+
+    def build(self):
+        postings = {}
+        for row in self.model.objects.values_list('id', *self.fields).iterator():
+            for text in row[1:]:
+                for token in tokenize(text):
+                    postings.setdefault(token, set()).add(row[0])
+        self.vocabulary, self.postings = sorted(postings), postings
+        self.built_on = time.time()
+
+    def is_stale(self):
+        max_age = getattr(settings, 'TEXT_INDEX_MAX_AGE', 3600)
+        return self.built_on is None or (max_age and time.time() - self.built_on > max_age)
+
+    def matches(self, word):
+        ids = set()
+        i = bisect_left(self.vocabulary, word)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(word):
+            ids.update(self.postings[self.vocabulary[i]])
+            i += 1
+        if not ids and getattr(settings, 'TEXT_INDEX_FUZZY', True):
+            for token in difflib.get_close_matches(word, self.vocabulary, FUZZY_MATCHES, FUZZY_CUTOFF):
+                ids.update(self.postings[token])
+        return ids
+
+    def lookup(self, text):
+        """
+        Returns the ids of the rows that match every word of text, or None when text has no words
+        """
+        words = tokenize(text)
+        if not words:
+            return None
+        ids = None
+        for word in words:
+            ids = self.matches(word) if ids is None else ids & self.matches(word)
+            if not ids:
+                break
+        return ids
+
+def get_index(model):
+    with _indexes_lock:
+        index = _indexes.get(model)
+        if index is None:
+            fields = ('name', 'type', 'alternate_name_1', 'alternate_name_2', 'alternate_name_3') if model is Fish else ('method',)
+            index = _indexes[model] = TokenIndex(model, fields)
+    with index.lock:
+        if index.is_stale():
+            index.build()
+    return index
+
+def fish_ids(text):
+    return get_index(Fish).lookup(text)
+
+def method_ids(text):
+    return get_index(FishingType).lookup(text)
+
+def invalidate(sender, **kwargs):
+    index = _indexes.get(sender)
+    if index is not None:
+        index.built_on = None
+
+for model in (Fish, FishingType):
+    post_save.connect(invalidate, sender=model, dispatch_uid='textindex_save_%s' % model.__name__)
+    post_delete.connect(invalidate, sender=model, dispatch_uid='textindex_delete_%s' % model.__name__)
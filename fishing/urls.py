@@ -5,4 +5,6 @@ urlpatterns = patterns('myproject.fishing.views',
                        url(r'^xmlhttp/search/$', 'searchDisplay',
                            { 'template_name':'results.html' }, name='AJAXsearch'),
                        url(r'^xmlhttp/fish/$', 'XMLfish', name='AJAXfish'),
+                       url(r'^xmlhttp/location/$', 'XMLlocation', name='AJAXlocation'),
+                       url(r'^xmlhttp/method/$', 'XMLmethod', name='AJAXmethod'),
 )
@@ -1,82 +1,41 @@
 import re
+import base64
 from datetime import datetime, timedelta
 
-from django.db.models import Q, F, Max, Min
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models import Q, F
 from django.contrib.localflavor.us import us_states
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified
 from django.shortcuts import render_to_response, render
 from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.utils import simplejson as json
 
-from myproject.custom import GoogleLatLng
+from myproject.custom import get_geocoder
+from myproject.location.geo import distance_sql, bounding_box_sql, join_derived
 from myproject.location.models import BaseLocation
-from myproject.fishing.models import WaterBody, Fish, FishingType
-from myproject.gprofile.models import GuideCore, name_cal
+from myproject.fishing.models import WaterBody, Fish, FishingType, PlaceName, faq_mask
+from myproject.gprofile.models import GuideCore, GuideSearchDoc, name_cal
+from myproject.tdetails.models import BookedDay
+from myproject.fishing import autocomplete, engine, searchcache, textindex
+from myproject.fishing.searchkeys import locKey, nullsFirst, ordKeys
 
 # Create your views here.
 
 def locDetermine(location):
-    params = location.split(',')
-    for a in range(len(params)):
-        params[a] = params[a].strip()
-    if len(params) == 1:
-        test = BaseLocation.objects.filter(city__icontains=params[0])
-        if not test.exists():
-            test = BaseLocation.objects.filter(Q(state__key__iexact=params[0]) | Q(state__name__icontains=params[0]))
-            if not test.exists():
-                test = BaseLocation.objects.filter(Q(country__abbr__iexact=params[0]) | Q(country__name__icontains=params[0]))
-                if not test.exists():
-                    test = WaterBody.objects.filter(name__icontains=params[0])
-                    if not test.exists():
-                        return (None, None)
-                    else:
-                        return test[0], ['natural_feature',]
-                else:
-                    return test[0], ['country',]
-            else:
-                return test[0], ['administrative_area_level_1',]
-        else:
-            return test[0], ['city',]
-    elif len(params) == 2:
-        test = BaseLocation.objects.filter(Q(city__icontains=params[0]),
-                                           Q(state__key__iexact=params[1]) | Q(state__name__icontains=params[1]))
-        if not test.exists():
-            test = BaseLocation.objects.filter(Q(state__key__iexact=params[0]) | Q(state__name__icontains=params[0]),
-                                               Q(country__abbr__iexact=params[1]) | Q(country__name__icontains=params[1]))
-            if not test.exists():
-                test = WaterBody.objects.filter(Q(name__icontains=params[0]),
-                                                Q(state__key__iexact=params[1]) | Q(state__name__icontains=params[1]) |
-                                                Q(country__abbr__iexact=params[1]) | Q(country__name__icontains=params[1]))
-                if not test.exists():
-                    return None, None
-                else:
-                    return test[0], ['natural_feature',]
-            else:
-                return test[0], ['administrative_area_level_1',]
-        else:
-            return test[0], ['city',]
-    else:
-        test = BaseLocation.objects.filter(Q(city__icontains=params[0]),
-                                           Q(state__key__iexact=params[1]) | Q(state__name__icontains=params[1]),
-                                           Q(country__abbr__iexact=params[2]) | Q(country__name__icontains=params[2]))
-        if not test.exists():
-            test = WaterBody.objects.filter(Q(name__icontains=params[0]),
-                                            Q(state__key__iexact=params[1]) | Q(state__name__icontains=params[1]),
-                                            Q(country__abbr__iexact=params[2]) | Q(country__name__icontains=params[2]))
-            if not test.exists():
-                return None, None
-            else:
-                return test[0], ['natural_feature',]
-        else:
-            return test[0], ['city',]
+    """
+    Returns (obj, types) for a place name of the form "place", "place, region" or "place, state, country"
+    """
+    return PlaceName.objects.resolve(location)
 
-def locQuery(location, **kwargs):
+def locResolve(location):
     """
-    Function to return matching locations. Can be optimized in 2 manners:
-    1) Get rid of for loops on WaterBody and BaseLocation querysets
-    2) Optimize locDetermine()
+    Returns (loc, types) for a search location, falling back to the geocoder for places that are not
+    known yet, which are then saved. (None, None) when the location cannot be found.
     """
-    q = GoogleLatLng()
-    query = GuideCore.objects.none()
+    q = get_geocoder()
     loc, type = locDetermine(location)
     if not type:
         if q.requestLatLngJSON(location):
@@ -93,166 +52,298 @@ def locQuery(location, **kwargs):
                 newloc.save(mquery=q)
             except:
                 pass
-            if newloc.id: newloc.associate_locations()
-        else:
-            return query
+    return loc, type
+
+def locQuery(location, **kwargs):
+    """
+    Function to return matching locations
+    """
+    loc, type = locResolve(location)
+    return placeQuery(loc, type, **kwargs)
+
+def placeQuery(loc, type, **kwargs):
+    """
+    The guides of a location returned by locResolve
+    """
+    if not type:
+        return GuideCore.objects.none()
     rad = kwargs.get('radius', 100)
     if 'country' in type:
         # If it was a search by Country name
-        try:
-            l = loc.results['address_components'][0]['short_name']
-        except:
-            l = loc.country.abbr
-        query = GuideCore.objects.filter(Q(locations__country__abbr=l))
+        query = GuideCore.objects.filter(id__in=GuideCore.locations.through.objects.filter(
+            baselocation__country__abbr=locKey(loc, type)).values('guidecore'))
     elif 'administrative_area_level_1' in type:
         # If it was a search by a state name
-        try:
-            l = loc.results['address_components'][0]['short_name']
-        except:
-            l = loc.state.key
-        query = GuideCore.objects.filter(Q(locations__state__key=l))
+        query = GuideCore.objects.filter(id__in=GuideCore.locations.through.objects.filter(
+            baselocation__state__key=locKey(loc, type)).values('guidecore'))
     else:
         # If is was a search by a city name or a WaterBody
-        locs = BaseLocation.neighbours.nearby_locations(loc.lat, loc.lng, rad, True).select_related('FishingGuides')
-        for l in locs:
-            query = query | GuideCore.objects.filter(locations=l)
-        locs = WaterBody.neighbours.nearby_locations(loc.lat, loc.lng, rad, True).select_related('Operators')
-        for w in locs:
-            query = query | GuideCore.objects.filter(waterbodies=w)
+        query = nearQuery(loc.lat, loc.lng, rad)
     return query
 
+def nearJoin(lat, lng, rad):
+    """
+    The derived table of nearQuery: the distance from (lat, lng) to the nearest location or water body of
+    each guide within rad miles. The distances are computed once per location and grouped by guide, and
+    the guides are joined to the result, so it serves both the filter and the ordering.
+    """
+    qn = connection.ops.quote_name
+    near, params = [], []
+    for field in (GuideCore._meta.get_field('locations'), GuideCore._meta.get_field('waterbodies')):
+        distance, distance_params = distance_sql(lat, lng, True, table='l')
+        box, box_params = bounding_box_sql(lat, lng, int(rad), True, table='l')
+        near.append("""SELECT t.%s AS guide_id, %s AS distance FROM %s t INNER JOIN %s l ON l.id = t.%s
+        WHERE %s""" % (qn(field.m2m_column_name()), distance, qn(field.m2m_db_table()),
+                      qn(field.rel.to._meta.db_table), qn(field.m2m_reverse_name()), box))
+        params.extend(distance_params + box_params)
+    nearest = """SELECT near.guide_id, MIN(near.distance) AS distance FROM (%s) near WHERE near.distance < %%s
+    GROUP BY near.guide_id""" % ' UNION ALL '.join(near)
+    return nearest, params + [int(rad)], 'nearest', 'guide_id'
+
+def nearQuery(lat, lng, rad):
+    """
+    Guides that operate from a location or on a water body within rad miles of (lat, lng), annotated with
+    the distance to the nearest of them
+    """
+    return join_derived(GuideCore.objects.extra(select={ 'distance':'nearest.distance' }), *nearJoin(lat, lng, rad))
+
 def datQuery(query, date):
     """
-    Search for date might take too long. Can be optimized, and should be with location
+    Leaves out the guides with a trip or a blackout on date, read from the BookedDay index
     """
-    return query
+    return query.exclude(id__in=BookedDay.objects.booked(date))
 
 def fisQuery(query, **kwargs):
+    """
+    Fish and methods are resolved to ids with the token index, which understands plurals and misspellings.
+    Text that matches no word there is looked for anywhere in the names, as before.
+    """
     fish = kwargs.get('fish')
     watertype = kwargs.get('watertype')
     method = kwargs.get('method')
     if fish:
-        query = query.filter(Q(fish__name__icontains=fish) |
-                             Q(fish__type__icontains=fish) |
-                             Q(fish__alternate_name_1__icontains=fish) |
-                             Q(fish__alternate_name_2__icontains=fish) |
-                             Q(fish__alternate_name_3__icontains=fish))
+        ids = textindex.fish_ids(fish)
+        if ids:
+            query = query.filter(id__in=GuideCore.fish.through.objects.filter(fish__in=ids).values('guidecore'))
+        else:
+            query = query.filter(SearchDoc__fish_text__contains=fish.lower())
     if watertype:
-        query = query.filter(fish__water_type__iexact=watertype)
+        query = query.filter(SearchDoc__water_types__contains='|%s|' % watertype.lower())
     if method:
-        query = query.filter(methods__method__icontains=method)
+        ids = textindex.method_ids(method)
+        if ids:
+            query = query.filter(id__in=GuideCore.methods.through.objects.filter(fishingtype__in=ids).values('guidecore'))
+        else:
+            query = query.filter(SearchDoc__method_text__contains=method.lower())
     return query
 
 def groQuery(query, **kwargs):
     boatsize = int(kwargs.get('boatsize', 0))
     partysize = int(kwargs.get('partysize', 0))
     if boatsize:
-        query = query.annotate(max_boat=Max('boats__boat_length')).exclude(max_boat__lt=int(boatsize))
-        query = query.annotate(min_boat=Min('boats__boat_length')).exclude(min_boat__gt=int(boatsize))
+        query = query.filter(SearchDoc__max_boat__gte=boatsize, SearchDoc__min_boat__lte=boatsize)
     if partysize:
-        query = query.filter(PartyModel__max_party__gte=partysize, PartyModel__min_party__lte=partysize)
+        query = query.filter(SearchDoc__max_party__gte=partysize, SearchDoc__min_party__lte=partysize)
     return query
 
 def priQuery(query, **kwargs):
     if kwargs.get('price'):
         maxprice = float(kwargs.get('maxprice', 99999999.99))
         minprice = float(kwargs.get('minprice', 0))
-        query = query.filter(search_price__gte=minprice, search_price__lte=maxprice)
+        query = query.filter(SearchDoc__search_price__gte=minprice, SearchDoc__search_price__lte=maxprice)
     return query
 
 def faqQuery(query, **kwargs):
+    """
+    The FAQ filters are one predicate on the packed GuideFAQ.flags kept in GuideSearchDoc
+    """
     isnew = kwargs.get('isnew')
-    cf = kwargs.get('child_friendly')
-    al = kwargs.get('alcohol_allowed')
-    fp = kwargs.get('food_provided')
-    cr = kwargs.get('capture_release')
-    sc = kwargs.get('state_certified')
-    cg = kwargs.get('CG_certified')
-    hf = kwargs.get('handicap_friendly')
-    pe = kwargs.get('personal_equipment')
-    lt = kwargs.get('lost_tackle')
-    fs = kwargs.get('fillet_services')
-    ts = kwargs.get('taxidermy_services')
-    ai = kwargs.get('allow_international')
     if isnew:
         isnew = False if isnew == 'False' else True
         query = query.filter(is_new=isnew)
-    if cf:
-        cf = False if cf == 'False' else True
-        query = query.filter(faq__child_friendly=cf)
-    if al:
-        al = False if al == 'False' else True
-        query = query.filter(faq__alcohol_allowed=al)
-    if fp:
-        fp = False if fp == 'False' else True
-        query = query.filter(faq__food_provided=fp)
-    if cr:
-        cr = False if cr == 'False' else True
-        query = query.filter(faq__capture_release=cr)
-    if sc:
-        sc = False if sc == 'False' else True
-        query = query.filter(faq__state_certified=sc)
-    if cg:
-        cg = False if cg == 'False' else True
-        query = query.filter(faq__CG_certified=cg)
-    if hf:
-        hf = False if hf == 'False' else True
-        query = query.filter(faq__handicap_friendly=hf)
-    if pe:
-        pe = False if pe == 'False' else True
-        query = query.filter(faq__personal_equipment=pe)
-    if lt:
-        lt = False if lt == 'False' else True
-        query = query.filter(faq__lost_tackle=lt)
-    if fs:
-        fs = False if fs == 'False' else True
-        query = query.filter(faq__fillet_services=fs)
-    if ts:
-        ts = False if ts == 'False' else True
-        query = query.filter(faq__taxidermy_services=ts)
-    if ai:
-        ai = False if ai == 'False' else True
-        query = query.filter(faq__allow_international=ai)
+    mask, required = faq_mask(**kwargs)
+    if mask:
+        matching = GuideSearchDoc.objects.extra(where=['(faq_flags & %s) = %s'], params=[mask, required])
+        query = query.filter(id__in=matching.values('guide'))
     return query
 
 def retQuery(location, day, **kwargs):
-    query = locQuery(location, **kwargs)  # Filter based on Location
+    return filterQuery(locQuery(location, **kwargs), day, **kwargs) # Filter based on Location, then the rest
+
+def filterQuery(query, day, **kwargs):
+    """
+    The filters read the GuideSearchDoc of each guide, a single joined row, so no stage multiplies the rows
+    """
     if query.exists():
         query = datQuery(query, day)      # Filter based on Date
         query = fisQuery(query, **kwargs) # Filter based on Fish, WaterType and FishingMethod
         query = groQuery(query, **kwargs) # Filter based on BoatSize and Number of People
         query = priQuery(query, **kwargs) # Filter based on Price
         query = faqQuery(query, **kwargs) # Filter based on FAQ's (including new)
-    return query.distinct()
+    return query
 
 def ordQuery(query, ordering):
-    sort = ['full_day_price', '-profile__num_recommends', '-experience', 'person__first_name', 'person__last_name', '-PartyModel__avg_party']
-    if not ordering or ordering == 'price':
-        new_sort = sort
-    if ordering == 'recommend':
-        new_sort = list(sort.pop(1))
-        new_sort.extend(sort)
-    if ordering == 'experience':
-        new_sort = list(sort.pop(2))
-        new_sort.extend(sort)
-    if ordering == 'alpha':
-        new_sort = [sort.pop(3), sort.pop(4)]
-        new_sort.extend(sort)
-    if ordering == 'party' or ordering == 'boat':
-        new_sort = list(sort.pop(5))
-        new_sort.extend(sort)
-        if ordering == 'boat':
-            return query.annotate(max_length=Max('boats__boat_length')).order_by('-max_length', *new_sort)
-    return query.order_by(*new_sort)
+    return query.order_by(*ordKeys(ordering, 'distance' in query.query.extra))
 
-def parQuery(location, pday, **kwargs):
+def searchDay(pday):
     if pday == '':
-        day = datetime.today()+timedelta(1)
-    else:
-        day = datetime.strptime(pday, '%m/%d/%Y')
+        return datetime.today()+timedelta(1)
+    return datetime.strptime(pday, '%m/%d/%Y')
+
+def parQuery(location, pday, **kwargs):
+    day = searchDay(pday)
     query = ordQuery(retQuery(location, day, **kwargs), kwargs.get('ordering'))
     return query
 
+def encodeCursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=unicode))
+
+def decodeCursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        return None
+    return values if isinstance(values, list) else None
+
+def cursorOffset(values):
+    """
+    The offset held by a decoded offset cursor, 0 when there is none
+    """
+    if values and isinstance(values[0], (int, long)) and not isinstance(values[0], bool) and values[0] > 0:
+        return values[0]
+    return 0
+
+def sortField(model, name):
+    """
+    The model field at the end of the lookup path name, like 'profile__num_recommends'
+    """
+    for part in name.split('__'):
+        field, related, direct, m2m = model._meta.get_field_by_name(part)
+        if not direct:
+            field, model = None, field.model
+        elif field.rel:
+            model = field.rel.to
+    return field or model._meta.pk
+
+def cursorValues(model, fields, values):
+    """
+    The sort key of a keyset cursor converted to the types of the ordering fields, or None when the
+    cursor does not fit them, so that a stale or crafted cursor starts over from the first page
+    """
+    if not values or len(values) != len(fields):
+        return None
+    try:
+        return [None if value is None else sortField(model, name).to_python(value)
+                for (name, desc), value in zip(fields, values)]
+    except (ValidationError, FieldDoesNotExist, TypeError, ValueError):
+        return None
+
+def keysetQ(fields, values):
+    """
+    Rows that sort after values under the ordering fields, a list of (name, descending) pairs.
+    NULLs are placed the way the database sorts them, see nullsFirst.
+    """
+    (name, desc), value = fields[0], values[0]
+    if value is None:
+        after = Q(**{name + '__isnull': False}) if nullsFirst(desc) else None
+        same = Q(**{name + '__isnull': True})
+    else:
+        after = Q(**{name + ('__lt' if desc else '__gt'): value})
+        if not nullsFirst(desc):
+            after = after | Q(**{name + '__isnull': True})
+        same = Q(**{name: value})
+    if len(fields) == 1:
+        return after if after is not None else Q(id__in=[])
+    rest = same & keysetQ(fields[1:], values[1:])
+    return rest if after is None else after | rest
+
+def searchPage(location, pday, cursor='', **kwargs):
+    """
+    Returns (ids, next cursor) for one page of the guides that parQuery finds. Pages are read with keyset
+    pagination on the sort key of ordQuery, so the database only ever reads up to the page boundary.
+    The cursor holds the sort key of the last guide of the previous page.
+    Orderings on aggregates cannot be compared in a WHERE clause; those pages fall back to an offset.
+    Nearest first orderings grow the search circle only as far as the page needs, see nearestRows.
+    With settings.SEARCH_ENGINE the whole search runs in memory instead, and pages are offsets into it.
+    """
+    size = getattr(settings, 'SEARCH_PAGE_SIZE', 50)
+    if engine.enabled():
+        return enginePage(location, pday, cursor, size, **kwargs)
+    loc, type = locResolve(location)
+    if not type:
+        return [], None
+    query = filterQuery(placeQuery(loc, type, **kwargs), searchDay(pday), **kwargs)
+    query = ordQuery(query, kwargs.get('ordering'))
+    fields = [(name.lstrip('-'), name.startswith('-')) for name in query.query.order_by]
+    if 'id' not in [name for name, desc in fields]:
+        fields.append(('id', False))
+    names = [name for name, desc in fields]
+    query = query.order_by(*[('-' if desc else '') + name for name, desc in fields])
+    keyset = not [name for name in names if name in query.query.aggregates or name in query.query.extra]
+    position = decodeCursor(cursor)
+    if keyset:
+        position = cursorValues(query.model, fields, position)
+        if position:
+            query = query.filter(keysetQ(fields, position))
+        rows = list(query.values_list(*names)[:size + 1])
+    elif names[0] == 'distance':
+        offset = cursorOffset(position)
+        rows = nearestRows(query, loc, names, offset + size + 1, kwargs.get('radius', 100))[offset:]
+    else:
+        offset = cursorOffset(position)
+        rows = list(query.values_list(*names)[offset:offset + size + 1])
+    more = len(rows) > size
+    rows = rows[:size]
+    next = None
+    if more:
+        next = encodeCursor(list(rows[-1]) if keyset else [offset + size])
+    return [row[names.index('id')] for row in rows], next
+
+def nearestRows(query, loc, names, count, radius):
+    """
+    The first count rows of query, a search around loc ordered nearest first. The search starts with a
+    circle of settings.SEARCH_FIRST_RING miles and doubles it until count guides are found or the circle
+    reaches radius; only the derived table of nearQuery changes between circles, the location and the
+    filters are resolved once. Every guide outside a circle is farther than every guide inside it, so the
+    first count guides of a circle are the first of the whole search, and a wide search near a busy place
+    never reads the guides far away.
+    """
+    radius = int(radius)
+    ring = min(getattr(settings, 'SEARCH_FIRST_RING', 25), radius)
+    while True:
+        ringed = query._clone()
+        ringed.query.joined = nearJoin(loc.lat, loc.lng, ring)
+        rows = list(ringed.values_list(*names)[:count])
+        if len(rows) == count or ring >= radius:
+            return rows
+        ring = min(max(ring * 2, 1), radius)
+
+def enginePage(location, pday, cursor, size, **kwargs):
+    loc, type = locResolve(location)
+    position = decodeCursor(cursor)
+    offset = cursorOffset(position)
+    ids = engine.get_engine().search(loc, type, searchDay(pday), offset + size + 1, **kwargs) if type else []
+    next = encodeCursor([offset + size]) if len(ids) > offset + size else None
+    return ids[offset:offset + size], next
+
+def cachedSearch(location, pday, cursor='', **kwargs):
+    """
+    searchPage, served from the search cache when possible
+    """
+    key = searchcache.key(location, searchDay(pday), kwargs, cursor)
+    page = searchcache.get(key)
+    if page is None:
+        page = searchPage(location, pday, cursor, **kwargs)
+        searchcache.put(key, page)
+    return page
+
+def guidesById(ids):
+    """
+    The guides with the given ids, in that order, ready to be rendered by the result templates
+    """
+    guides = GuideCore.objects.for_display().in_bulk(ids)
+    return [guides[id] for id in ids if id in guides]
+
 def searchDisplay(request, template_name='display.html'):
     location = ''
     if request.method == 'GET':
@@ -267,9 +358,14 @@ def searchDisplay(request, template_name='display.html'):
             return HttpResponseRedirect(settings.DOMAIN)
         else:
             return render(request, template_name, { 'guides_list':[] })
-    diction = dict(request.GET.items())
-    guides = parQuery(location, day, **diction)
-    return render(request, template_name, { 'guides_list': list(guides)[:50] })
+    diction = dict((name, value) for name, value in request.GET.items() if name in searchcache.PARAMETERS)
+    ids, cursor = cachedSearch(location, day, request.GET.get('cursor', ''), **diction)
+    next_page = None
+    if cursor:
+        params = request.GET.copy()
+        params['cursor'] = cursor
+        next_page = params.urlencode()
+    return render(request, template_name, { 'guides_list': guidesById(ids), 'next_page': next_page })
 
 def testSearch(**kwargs):
     location = kwargs.get('loc', '')
@@ -283,58 +379,37 @@ def testSearch(**kwargs):
     guides = parQuery(location, day, **kwargs)
     return ("Send in results", list(guides))
 
-def XMLfish(request):
-    if request.method == 'GET':
-        name = request.GET.get('fish', ' ')
-        q = Fish.objects.filter(Q(type__istartswith=name) |
-                                Q(name__istartswith=name) |
-                                Q(alternate_name_1__istartswith=name) |
-                                Q(alternate_name_2__istartswith=name) |
-                                Q(alternate_name_3__istartswith=name)).order_by('type','name','alternate_name_1')
-        message = ""
-        if q:
-            for a in q:
-                message += a.name + ', '
+def autocompleteResponse(request, name, param, separator):
+    """
+    Completions of the prefix in request.GET[param], at most ?limit= of them. Responses can be cached by
+    the browser for settings.AUTOCOMPLETE_CACHE_SECONDS and are revalidated with their ETag.
+    """
+    if request.method != 'GET':
+        return HttpResponse("")
+    try:
+        limit = int(request.GET.get('limit', 0)) or None
+    except ValueError:
+        limit = None
+    body, etag = autocomplete.render(name, request.GET.get(param, ' '), separator, limit)
+    if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
     else:
-        message = ""
-    return HttpResponse(message)
+        response = HttpResponse(body)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'AUTOCOMPLETE_CACHE_SECONDS', 300))
+    return response
+
+def XMLfish(request):
+    return autocompleteResponse(request, 'fish', 'fish', ', ')
 
 def XMLlocation(request):
-    if request.method == 'GET':
-        message = ""
-        location = request.GET.get('loc', ' ')
-        # Filter and get possibilites for cities
-        q = BaseLocation.objects.filter(city__istartswith=location)
-        for a in q:
-            message += a.city + ', ' + a.state.key + ', ' + a.country.abbr + ';'
-        # Filter and get possibilies for states
-        q = BaseLocation.objects.filter(Q(state__key__istartswith=location) |
-                                        Q(state__name__istartswith=location))
-        for a in q:
-            message += a.state.name + ', ' + a.country.abbr + ';'
-        # Filter and get possibilities for countries
-        q = BaseLocation.objects.filter(Q(country__name__istartswith=location) |
-                                        Q(country__abbr__istartswith=location))
-        for a in q:
-            message += a.country.name + ';'
-        # Filter and sort by potential waterbodies
-        q = WaterBody.objects.filter(name__istartswith=location)
-        for a in q:
-            message += a.name + ';'
-    else:
-        message = ""
-    return HttpResponse(message)
+    """
+    Completions for cities, states, countries and water bodies, in that order
+    """
+    return autocompleteResponse(request, 'location', 'loc', ';')
 
 def XMLmethod(request):
-    if request.method == "GET":
-        type = request.GET.get('method', ' ')
-        message = ""
-        q = FishingType.objects.filter(method__istartswith=type)
-        for a in q:
-            message += a.method + ';'
-    else:
-        message = ""
-    return HttpResponse(message)
+    return autocompleteResponse(request, 'method', 'method', ';')
 
 #def XMLboats(request):
 #    message = ""
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject.fishing import searchcache
+from myproject.gprofile.models import GuideCore, GuideSearchDoc
+
+class Command(BaseCommand):
+    help = ("Adds to every guide the water bodies related to their locations, then the locations related "
+            "to their water bodies, the same way a new guide is set up. Guides without a search document, "
+            "e.g. inserted in bulk, get one.")
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        start = time.time()
+        water = GuideCore.objects.associate_water()
+        land = GuideCore.objects.associate_land()
+        docs = GuideSearchDoc.objects.ensure()
+        searchcache.invalidate_engine()
+        self.stdout.write("Added %d water bodies, %d locations and %d search documents in %.1f s\n" %
+                          (water, land, docs, time.time() - start))
@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject.fishing import searchcache
+from myproject.gprofile.models import GuideSearchDoc
+
+class Command(BaseCommand):
+    help = "Rebuilds the GuideSearchDoc row of every guide, which the search filters read"
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        start = time.time()
+        count = GuideSearchDoc.objects.refresh()
+        searchcache.invalidate_engine()
+        self.stdout.write("Rebuilt %d search documents in %.1f s\n" % (count, time.time() - start))
@@ -1,8 +1,8 @@
 from datetime import datetime, time, timedelta, date
 
-from django.db import models
-from django.db.models import Sum, Avg, Count, Q
-from django.db.models.signals import post_save, post_delete
+from django.db import models, connection, transaction
+from django.db.models import Sum, Avg, Count, Q, Min, Max
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.conf import settings
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.dispatch import receiver, Signal
@@ -11,6 +11,8 @@ from django.template.defaultfilters import slugify
 from myproject.location.models import BaseLocation, Country
 from myproject.customer.models import CustomerCore, ContactInfo, CustomerProfile
 from myproject.fishing.models import FishingType, Fish, GuideFAQ, BoatBrand, WaterBody, ExtraDetails, GuideBoat
+from myproject.fishing.models import GeoRelations
+from myproject.fishing import searchcache
 
 # Create your models here.
 
@@ -78,6 +80,67 @@ class GuideProfile(models.Model):
     def __unicode__(self):
         return "Profile for Guide %s" % self.cust_profile.CustomerMain.full_name
 
+class GuideCoreManager(models.Manager):
+    def _associate(self, source, target, source_col, target_col, ids=None):
+        """
+        Adds to the target m2m of each guide every row that GeoRelations relates to the rows in its source m2m.
+        The missing through rows are found with one query and inserted in bulk. ids restricts the
+        guides, all of them are associated when it is None. Returns the number of rows added.
+        """
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return 0
+        qn = connection.ops.quote_name
+        src, dst = self.model._meta.get_field(source), self.model._meta.get_field(target)
+        sql = """SELECT DISTINCT s.%(s_guide)s, r.%(r_target)s FROM %(s_table)s s
+        INNER JOIN %(r_table)s r ON r.%(r_source)s = s.%(s_item)s
+        LEFT OUTER JOIN %(d_table)s d ON d.%(d_guide)s = s.%(s_guide)s AND d.%(d_item)s = r.%(r_target)s
+        WHERE d.%(d_item)s IS NULL""" % {
+            's_table': qn(src.m2m_db_table()), 's_guide': qn(src.m2m_column_name()), 's_item': qn(src.m2m_reverse_name()),
+            'd_table': qn(dst.m2m_db_table()), 'd_guide': qn(dst.m2m_column_name()), 'd_item': qn(dst.m2m_reverse_name()),
+            'r_table': qn(GeoRelations._meta.db_table), 'r_source': qn(source_col), 'r_target': qn(target_col),
+        }
+        cursor = connection.cursor()
+        if ids is None:
+            cursor.execute(sql)
+            missing = cursor.fetchall()
+        else:
+            missing = []
+            for offset in xrange(0, len(ids), 500):
+                chunk = ids[offset:offset+500]
+                cursor.execute(sql + " AND s.%s IN (%s)" % (qn(src.m2m_column_name()), ', '.join(['%s'] * len(chunk))), chunk)
+                missing.extend(cursor.fetchall())
+        through = dst.rel.through
+        guide_attr, item_attr = dst.m2m_field_name() + '_id', dst.m2m_reverse_field_name() + '_id'
+        rows = [through(**{guide_attr: guide, item_attr: item}) for guide, item in missing]
+        for offset in xrange(0, len(rows), 500):
+            through.objects.bulk_create(rows[offset:offset+500])
+        return len(rows)
+
+    def associate_land(self, ids=None):
+        """
+        Adds the locations related to the water bodies of the guides
+        """
+        return self._associate('waterbodies', 'locations', 'water_id', 'location_id', ids)
+
+    def associate_water(self, ids=None):
+        """
+        Adds the water bodies related to the locations of the guides
+        """
+        return self._associate('locations', 'waterbodies', 'location_id', 'water_id', ids)
+
+    def for_display(self):
+        """
+        Guides with everything the search result templates show loaded up front: the name, home
+        location and profile in the same query, then the fish, the galleries and their profile pictures
+        in one query each. The pictures hang off the galleries, a reverse relation, so select_related
+        cannot reach them.
+        """
+        return self.select_related('person__contact__state', 'person__contact__country',
+                                   'profile__cust_profile').prefetch_related(
+                                   'fish', 'profile__cust_profile__Galleries__profile_pic')
+
 class GuideCore(models.Model):
     is_paying = models.BooleanField(blank=True, default=False, editable=False)
     is_signed_up = models.BooleanField(blank=True, default=False, editable=False)
@@ -94,6 +157,8 @@ class GuideCore(models.Model):
     search_price = models.DecimalField(max_digits=10, decimal_places=2, editable=False, null=True)
     boat_brands = models.ManyToManyField(BoatBrand, related_name='Owners', blank=True, null=True, through=GuideBoat)
 
+    objects = GuideCoreManager()
+
     class Meta:
         verbose_name = "Core Guide Detail"
         verbose_name_plural = "Core Guide Details"
@@ -105,17 +170,28 @@ class GuideCore(models.Model):
         """
         Function to add locations of fishing for a guide, given the water bodies that he fishes in
         """
-        if self.waterbodies.all():
-            for w in self.waterbodies.all():
-                self.locations.add(*w.locations.all())
+        return GuideCore.objects.associate_land([self.id])
 
     def associate_water(self):
         """
         Function to add water bodies for a guide, given the locations that he fishes in
         """
-        if self.locations.all():
-            for l in self.locations.all():
-                self.waterbodies.add(*l.WaterBodies.all())
+        return GuideCore.objects.associate_water([self.id])
+
+    def link_home(self):
+        """
+        Adds the city of the guide's contact to the guide's locations, along with the water bodies around it.
+        Returns False when the city is not known yet, which with settings.DEFERRED_GEOCODING lasts until
+        the geocode_worker command has looked it up.
+        """
+        contact = self.person.contact
+        home = BaseLocation.objects.filter(city=contact.city, state=contact.state)[:1]
+        if not home:
+            return False
+        if home[0].city != '!':
+            self.locations.add(home[0])
+            self.associate_water()
+        return True
 
     def clean(self):
         if self.experience > settings.MAX_EXPERIENCE:
@@ -139,6 +215,114 @@ class GuideCore(models.Model):
                 self.is_new = False
         super(GuideCore, self).save(*args, **kwargs)
 
+class GuideSearchDocManager(models.Manager):
+    def refresh(self, ids=None):
+        """
+        Recomputes the documents of the guides with the given ids, or of every guide when ids is None.
+        Each batch of 500 guides costs a fixed number of queries. Returns the number of documents written.
+        """
+        if ids is None:
+            ids = GuideCore.objects.values_list('id', flat=True)
+        ids = list(ids)
+        count = 0
+        for offset in xrange(0, len(ids), 500):
+            count += self._refresh(ids[offset:offset+500])
+        return count
+
+    def _related(self, name, ids, *columns):
+        field = GuideCore._meta.get_field(name)
+        guide, item = field.m2m_field_name(), field.m2m_reverse_field_name()
+        return field.rel.through.objects.filter(**{guide + '__in': ids}).values_list(
+            guide, *[item + '__' + column for column in columns])
+
+    def _refresh(self, ids):
+        # One transaction, so that searches never see a guide between the delete and the insert. When the
+        # caller already manages a transaction the refresh is part of it; committing here would commit theirs.
+        if transaction.is_managed():
+            return self._write(ids)
+        with transaction.commit_on_success():
+            return self._write(ids)
+
+    def _write(self, ids):
+        docs = {}
+        for id, price, experience, recommends in GuideCore.objects.filter(id__in=ids).values_list(
+                'id', 'search_price', 'experience', 'profile__num_recommends'):
+            docs[id] = self.model(guide_id=id, search_price=price, experience=experience, num_recommends=recommends or 0)
+        for guide, low, high, avg in GuideParty.objects.filter(guide__in=docs.keys()).values_list(
+                'guide', 'min_party', 'max_party', 'avg_party'):
+            docs[guide].min_party, docs[guide].max_party, docs[guide].avg_party = low, high, avg
+        for faq in GuideFAQ.objects.filter(guide__in=docs.keys()):
+            docs[faq.guide_id].faq_flags = faq.flags
+        for row in GuideBoat.objects.filter(guide__in=docs.keys()).values('guide').annotate(low=Min('boat_length'),
+                                                                                          high=Max('boat_length')):
+            docs[row['guide']].min_boat, docs[row['guide']].max_boat = row['low'], row['high']
+        fish, waters, methods = {}, {}, {}
+        for row in self._related('fish', docs.keys(), 'name', 'type', 'alternate_name_1', 'alternate_name_2',
+                                 'alternate_name_3', 'water_type'):
+            fish.setdefault(row[0], []).extend(row[1:6])
+            waters.setdefault(row[0], []).append(row[6])
+        for guide, method in self._related('methods', docs.keys(), 'method'):
+            methods.setdefault(guide, []).append(method)
+        for id, doc in docs.items():
+            doc.fish_text = blob(sorted(set(fish.get(id, []))))
+            doc.water_types = blob(sorted(set(waters.get(id, []))))
+            doc.method_text = blob(methods.get(id))
+        self.filter(guide__in=ids).delete()
+        self.bulk_create(docs.values())
+        return len(docs)
+
+    def ensure(self):
+        """
+        Creates the documents of the guides that have none, such as guides inserted with bulk_create, which
+        sends no signals. Called by the associate_guides command, never while searching. Returns the number
+        of documents written.
+        """
+        ids = list(GuideCore.objects.filter(SearchDoc__isnull=True).values_list('id', flat=True))
+        if not ids:
+            return 0
+        count = self.refresh(ids)
+        searchcache.invalidate_engine()
+        return count
+
+    def update_boats(self, guide_id):
+        """
+        Recomputes the boat length bounds of one guide in place
+        """
+        bounds = GuideBoat.objects.filter(guide=guide_id).aggregate(low=Min('boat_length'), high=Max('boat_length'))
+        self.filter(guide=guide_id).update(min_boat=bounds['low'], max_boat=bounds['high'])
+
+def blob(values, separator='|'):
+    """
+    Lowercased values joined by separator, which also opens and closes the string, so that
+    a contains lookup on separator + value + separator only matches whole values
+    """
+    values = [v.lower() for v in (values or []) if v]
+    return separator + separator.join(values) + separator if values else ''
+
+class GuideSearchDoc(models.Model):
+    """
+    Everything the search filters of fishing.views read about a guide, flattened into one row. Locations
+    are not part of it: locQuery matches them through the locations and waterbodies relations. Kept up to date by the signals at the bottom of this file; rebuild with the rebuild_searchdocs command.
+    """
+    guide = models.OneToOneField(GuideCore, primary_key=True, related_name='SearchDoc')
+    fish_text = models.TextField(blank=True, default='', help_text="Names, types and alternate names of the fish")
+    water_types = models.CharField(max_length=20, blank=True, default='')
+    method_text = models.TextField(blank=True, default='')
+    min_boat = models.PositiveIntegerField(null=True, db_index=True)
+    max_boat = models.PositiveIntegerField(null=True, db_index=True)
+    min_party = models.IntegerField(null=True, db_index=True)
+    max_party = models.IntegerField(null=True, db_index=True)
+    avg_party = models.IntegerField(null=True)
+    search_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, db_index=True)
+    faq_flags = models.IntegerField(null=True, db_index=True, help_text="GuideFAQ.flags")
+    num_recommends = models.IntegerField(default=0, db_index=True)
+    experience = models.IntegerField(default=0, db_index=True)
+
+    objects = GuideSearchDocManager()
+
+    def __unicode__(self):
+        return 'Search document for guide %s' % self.guide_id
+
 def update_price(obj, **kwargs):
     dict = obj.guide.PaymentModels.aggregate(sum=Sum('amount'), avg=Avg('amount'), count=Count('id'))
     if not dict['count']:
@@ -164,14 +348,70 @@ def update_profile(sender, created=False, instance=False, **kwargs):
         party = GuideParty.objects.get_or_create(guide=instance, defaults={'guide':instance})
         FAQ = GuideFAQ.objects.get_or_create(guide=instance, defaults={'guide':instance})
         details = ExtraDetails.objects.get_or_create(guide=instance, defaults={'guide':instance})
-        home = BaseLocation.objects.get(city=instance.person.contact.city, state=instance.person.contact.state)
-        if home.city != '!':
-            instance.locations.add(home)
-            instance.associate_water()
+        instance.link_home()
         instance.associate_land()
         instance.save(force_update=True)
         return True
 
+# The documents are also refreshed on the raw saves of loaddata, which are the only way fixtures reach
+# them; a guide whose related rows are not loaded yet is refreshed again when they are
+def refresh_searchdoc(sender, instance=None, **kwargs):
+    if instance is None:
+        return
+    if sender is GuideCore:
+        ids = [instance.id]
+    elif sender is GuideProfile:
+        ids = GuideCore.objects.filter(profile=instance).values_list('id', flat=True)
+    elif sender in (Fish, FishingType):
+        ids = GuideCore.objects.filter(**{'fish' if sender is Fish else 'methods': instance}).values_list('id', flat=True)
+    else:
+        ids = [instance.guide_id]
+    GuideSearchDoc.objects.refresh(ids)
+
+def refresh_searchdoc_m2m(sender, instance=None, action='', reverse=False, pk_set=None, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            GuideSearchDoc.objects.refresh([instance.id])
+    elif action == 'pre_clear':
+        # A fish or method is about to be removed from all its guides; the post_clear does not say which
+        field = [f for f in GuideCore._meta.many_to_many if f.rel.through is sender][0]
+        instance._searchdoc_cleared = list(sender.objects.filter(**{field.m2m_reverse_field_name(): instance.pk}
+                                                                 ).values_list(field.m2m_field_name(), flat=True))
+    elif action == 'post_clear':
+        GuideSearchDoc.objects.refresh(getattr(instance, '_searchdoc_cleared', []))
+    elif action.startswith('post_'):
+        GuideSearchDoc.objects.refresh(pk_set)
+
+# Boats and parties are updated in place: when a guide is deleted they go first, and rebuilding the
+# whole document then would insert a row for a guide that is about to disappear
+def refresh_searchdoc_boats(sender, instance=None, **kwargs):
+    if instance is not None:
+        GuideSearchDoc.objects.update_boats(instance.guide_id)
+
+def clear_searchdoc_party(sender, instance=None, **kwargs):
+    if instance is not None:
+        GuideSearchDoc.objects.filter(guide=instance.guide_id).update(min_party=None, max_party=None, avg_party=None)
+
+def clear_searchdoc_faq(sender, instance=None, **kwargs):
+    if instance is not None:
+        GuideSearchDoc.objects.filter(guide=instance.guide_id).update(faq_flags=None)
+
+for model in (GuideCore, GuideParty, GuideProfile, GuideFAQ, Fish, FishingType):
+    post_save.connect(refresh_searchdoc, sender=model, dispatch_uid='searchdoc_save_%s' % model.__name__)
+post_save.connect(refresh_searchdoc_boats, sender=GuideBoat, dispatch_uid='searchdoc_save_GuideBoat')
+post_delete.connect(refresh_searchdoc_boats, sender=GuideBoat, dispatch_uid='searchdoc_delete_GuideBoat')
+post_delete.connect(clear_searchdoc_party, sender=GuideParty, dispatch_uid='searchdoc_delete_GuideParty')
+post_delete.connect(clear_searchdoc_faq, sender=GuideFAQ, dispatch_uid='searchdoc_delete_GuideFAQ')
+for name in ('fish', 'methods'):
+    m2m_changed.connect(refresh_searchdoc_m2m, sender=GuideCore._meta.get_field(name).rel.through,
+                        dispatch_uid='searchdoc_m2m_%s' % name)
+
+searchcache.connect(GuidePayment, GeoRelations)
+searchcache.connect(GuideCore, GuideParty, GuideProfile, GuideFAQ, GuideBoat, BaseLocation, WaterBody, Fish, FishingType,
+                    CustomerCore, engine=True)
+searchcache.connect_m2m(*[GuideCore._meta.get_field(name) for name in ('locations', 'waterbodies', 'fish', 'methods')],
+                        engine=True)
+
 # The following is the code to automatically add a calendar. Changes in the business model have made this
 # unnecessary. Could be used as reference though
 #            test = name_cal(self)
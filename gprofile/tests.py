@@ -5,8 +5,14 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from django.contrib.auth.models import User
 from django.test import TestCase
 
+from myproject.customer.models import ContactInfo, CustomerCore
+from myproject.fishing.models import Fish
+from myproject.gprofile.models import GuideCore, GuideSearchDoc
+from myproject.location.models import BaseLocation, Country, State
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +20,43 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class SearchDocTest(TestCase):
+    def setUp(self):
+        country = Country.objects.create(abbr='US', name='United States')
+        state = State.objects.create(country=country, name='Texas', key='TX')
+        BaseLocation.objects.bulk_create([BaseLocation(city='Austin', state=state, country=country, lat=30.27, lng=-97.74)])
+        self.bass = Fish.objects.create(name='Largemouth Bass', type='Bass', water_type='FW')
+        self.drum = Fish.objects.create(name='Red Drum', type='Drum', water_type='SW')
+        self.guides = []
+        for i in range(3):
+            user = User.objects.create(username='guide%d' % i, email='guide%d@example.com' % i)
+            person = CustomerCore.objects.get(user=user)
+            ContactInfo.objects.filter(id=person.contact_id).update(city='Austin', state=state, country=country)
+            guide = GuideCore(person=CustomerCore.objects.get(id=person.id))
+            guide.save()
+            self.guides.append(guide)
+
+    def fish_text(self, guide):
+        return GuideSearchDoc.objects.get(guide=guide).fish_text
+
+    def test_follows_fish(self):
+        self.guides[0].fish.add(self.bass, self.drum)
+        self.assertEqual(self.fish_text(self.guides[0]), '|bass|drum|largemouth bass|red drum|')
+        self.bass.FishCatchers.add(self.guides[1])
+        self.assertEqual(self.fish_text(self.guides[1]), '|bass|largemouth bass|')
+        self.guides[0].fish.remove(self.drum)
+        self.assertEqual(self.fish_text(self.guides[0]), '|bass|largemouth bass|')
+        self.bass.name = 'Smallmouth Bass'
+        self.bass.save()
+        self.assertEqual(self.fish_text(self.guides[1]), '|bass|smallmouth bass|')
+
+    def test_reverse_clear(self):
+        """
+        Clearing the guides of a fish refreshes only the guides that had it
+        """
+        self.bass.FishCatchers.add(*self.guides[:2])
+        GuideSearchDoc.objects.filter(guide=self.guides[2]).delete()
+        self.bass.FishCatchers.clear()
+        self.assertEqual([self.fish_text(guide) for guide in self.guides[:2]], ['', ''])
+        self.assertFalse(GuideSearchDoc.objects.filter(guide=self.guides[2]).exists())
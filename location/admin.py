@@ -1,10 +1,9 @@
 from django.contrib import admin
 from myproject.location.models import BaseLocation, Country, State
+from myproject.fishing.models import GeoRelations
 
 def update_water(modeladmin, request, queryset):
-    for obj in queryset:
-        for w in obj.WaterBodies.all():
-            w.associate_locations()
+    GeoRelations.custom.link_locations(queryset)
 update_water.short_description = "Update Water Bodies"
 
 class BaseLocationAdmin(admin.ModelAdmin):
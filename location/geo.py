@@ -0,0 +1,108 @@
+import math
+
+from django.db.models.sql.query import Query
+
+# Helpers for great-circle searches over the lat/lng columns of BaseLocation and WaterBody
+
+EARTH_RADIUS_KM = 6371
+EARTH_RADIUS_MILES = 3959
+
+def earth_radius(use_miles=False):
+    return EARTH_RADIUS_MILES if use_miles else EARTH_RADIUS_KM
+
+def bounding_box(latitude, longitude, radius, use_miles=False):
+    """
+    Returns (min_lat, max_lat, lng_ranges) in degrees for the smallest lat/lng box that contains every
+    point within radius of (latitude, longitude). lng_ranges is a list of (min_lng, max_lng) tuples, and
+    has two entries when the box wraps around the antimeridian.
+    """
+    angular = float(radius) / earth_radius(use_miles)
+    lat = math.radians(latitude)
+    min_lat = lat - angular
+    max_lat = lat + angular
+    if min_lat <= -math.pi/2 or max_lat >= math.pi/2:
+        # A pole is inside the circle, so every longitude is a candidate
+        return (math.degrees(max(min_lat, -math.pi/2)), math.degrees(min(max_lat, math.pi/2)), [(-180.0, 180.0)])
+    delta = math.degrees(math.asin(min(1.0, math.sin(angular) / math.cos(lat))))
+    min_lng = longitude - delta
+    max_lng = longitude + delta
+    if min_lng < -180.0:
+        lng_ranges = [(min_lng + 360.0, 180.0), (-180.0, max_lng)]
+    elif max_lng > 180.0:
+        lng_ranges = [(min_lng, 180.0), (-180.0, max_lng - 360.0)]
+    else:
+        lng_ranges = [(min_lng, max_lng)]
+    return (math.degrees(min_lat), math.degrees(max_lat), lng_ranges)
+
+def _column(table, name):
+    return '%s.%s' % (table, name) if table else name
+
+def distance_sql(latitude, longitude, use_miles=False, table=None):
+    """
+    Spherical law of cosines distance from (latitude, longitude) to the lat/lng columns of table.
+    Returns the SQL fragment and its params, for use in extra() or raw queries.
+    The columns are left unqualified when no table is given, which keeps the fragment valid after
+    Django relabels the table alias of a queryset used as a subquery.
+    The acos argument is capped at 1: for a point at the search centre rounding can push it just past 1,
+    where acos is NULL and the point would drop out of its own search.
+    """
+    lat, lng = _column(table, 'lat'), _column(table, 'lng')
+    sql = """(%%s * acos( least( 1, cos( radians(%%s) ) * cos( radians( %(lat)s ) ) *
+        cos( radians( %(lng)s ) - radians(%%s) ) + sin( radians(%%s) ) * sin( radians( %(lat)s ) ) ) ) )""" % { 'lat':lat, 'lng':lng }
+    return sql, [earth_radius(use_miles), latitude, longitude, latitude]
+
+def bounding_box_sql(latitude, longitude, radius, use_miles=False, table=None):
+    """
+    Range predicate on the lat/lng columns of table that narrows a radius search before the exact distance
+    is computed. Returns the SQL fragment and its params.
+    """
+    min_lat, max_lat, lng_ranges = bounding_box(latitude, longitude, radius, use_miles)
+    sql = "%s BETWEEN %%s AND %%s" % _column(table, 'lat')
+    params = [min_lat, max_lat]
+    lng_sql = []
+    for min_lng, max_lng in lng_ranges:
+        lng_sql.append("%s BETWEEN %%s AND %%s" % _column(table, 'lng'))
+        params.extend([min_lng, max_lng])
+    sql += " AND (" + " OR ".join(lng_sql) + ")"
+    return sql, params
+
+class JoinedCompiler(object):
+    """
+    Mixed into the SQL compiler of the database for a JoinedQuery
+    """
+    def get_from_clause(self):
+        result, params = super(JoinedCompiler, self).get_from_clause()
+        sql, joined_params, alias, column = self.query.joined
+        base = self.quote_name_unless_alias(self.query.tables[0])
+        result.insert(1, 'INNER JOIN (%s) %s ON (%s.%s = %s.%s)' % (sql, alias, alias, column, base,
+                                                                   self.connection.ops.quote_name(self.query.model._meta.pk.column)))
+        return result, params + list(joined_params)
+
+class JoinedQuery(Query):
+    """
+    A query that inner joins a derived table, given as joined = (sql, params, alias, column), on its column
+    holding the primary key of the model. extra() selects and orderings can then read the columns of alias.
+    """
+    compilers = {}
+
+    def clone(self, klass=None, memo=None, **kwargs):
+        obj = super(JoinedQuery, self).clone(klass, memo, **kwargs)
+        if 'joined' not in kwargs:
+            obj.joined = self.joined
+        return obj
+
+    def get_compiler(self, using=None, connection=None):
+        compiler = super(JoinedQuery, self).get_compiler(using, connection)
+        base = compiler.__class__
+        if base not in self.compilers:
+            self.compilers[base] = type('Joined' + base.__name__, (JoinedCompiler, base), {})
+        compiler.__class__ = self.compilers[base]
+        return compiler
+
+def join_derived(queryset, sql, params, alias, column):
+    """
+    queryset restricted to the rows whose primary key is in column of the rows of sql, joined as alias
+    """
+    queryset = queryset._clone()
+    queryset.query = queryset.query.clone(klass=JoinedQuery, joined=(sql, params, alias, column))
+    return queryset
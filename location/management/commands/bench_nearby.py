@@ -0,0 +1,57 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject.location import spatial
+from myproject.location.models import BaseLocation
+
+class Command(BaseCommand):
+    help = ("Benchmarks nearby_locations with and without the bounding box prefilter, and the in-memory "
+            "index when NumPy is installed, on synthetic locations")
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', default=1000000, help="Number of synthetic locations to insert"),
+        make_option('--queries', type='int', default=50, help="Number of radius searches to time"),
+        make_option('--radius', type='int', default=100, help="Search radius in miles"),
+        make_option('--seed', type='int', default=0, help="Seed for the random coordinates"),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        # Everything is rolled back at the end, the synthetic rows never reach the real table
+        try:
+            rand = random.Random(options['seed'])
+            points = [(rand.uniform(-60.0, 70.0), rand.uniform(-180.0, 180.0)) for i in xrange(options['count'])]
+            self.stdout.write("Inserting %d synthetic locations\n" % len(points))
+            for offset in xrange(0, len(points), 1000):
+                BaseLocation.objects.bulk_create([BaseLocation(city='Synthetic %d' % i, lat=lat, lng=lng)
+                                                  for i, (lat, lng) in enumerate(points[offset:offset+1000], offset)])
+            centres = rand.sample(points, min(options['queries'], len(points)))
+            timings = {}
+            for prefilter in (False, True):
+                start = time.time()
+                results = []
+                for lat, lng in centres:
+                    near = BaseLocation.neighbours.nearby_locations(lat, lng, options['radius'], True, prefilter=prefilter)
+                    results.append(set(near.values_list('id', flat=True)))
+                timings[prefilter] = (time.time() - start, results)
+            modes = [(False, 'full scan'), (True, 'bounding box')]
+            if spatial.numpy is not None:
+                index = spatial.GeoIndex(BaseLocation)
+                start = time.time()
+                index.build()
+                self.stdout.write("Built the in-memory index in %.2f s\n" % (time.time() - start))
+                start = time.time()
+                results = [set(index.nearby(lat, lng, options['radius'], True)) for lat, lng in centres]
+                timings['index'] = (time.time() - start, results)
+                modes.append(('index', 'index'))
+            for mode, label in modes[1:]:
+                if timings[mode][1] != timings[False][1]:
+                    self.stderr.write("The %s search returned different locations from the full scan\n" % label)
+            for mode, label in modes:
+                elapsed = timings[mode][0]
+                self.stdout.write("%-12s %8.2f ms/query\n" % (label, 1000 * elapsed / len(centres)))
+        finally:
+            transaction.rollback()
@@ -0,0 +1,166 @@
+import csv
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import simplejson as json
+
+from myproject.custom import get_geocoder, normalize_address
+from myproject.location import spatial
+from myproject.location.models import BaseLocation, Country, State
+from myproject.fishing.models import WaterBody, GeoRelations
+
+BATCH_SIZE = 500
+
+def geocode(job):
+    """
+    Runs in the worker threads. job is (address, water), returns (address, water, geocoder) or
+    (address, water, None) when the address could not be resolved.
+    """
+    address, water = job
+    geocoder = get_geocoder()
+    try:
+        if geocoder.requestLatLngJSON(address, water) and geocoder.parseLocation():
+            return address, water, geocoder
+    except Exception:
+        pass
+    return address, water, None
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for offset in xrange(0, len(items), size):
+        yield items[offset:offset+size]
+
+class Command(BaseCommand):
+    args = '<file.csv|file.jsonl>'
+    help = ("Geocodes a CSV or JSONL file of addresses concurrently and inserts the new cities and water bodies "
+            "in bulk. Each row has an 'address' and optionally a 'type' of 'city' (default) or 'water'.")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=8, help="Number of concurrent geocoder requests"),
+        make_option('--water', action='store_true', default=False, help="Treat rows without a type as water bodies"),
+        make_option('--no-associate', action='store_false', dest='associate', default=True,
+                    help="Do not relate the new rows to nearby locations and water bodies"),
+    )
+
+    def read(self, path, water):
+        rows = []
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            for line in open(path):
+                if line.strip():
+                    rows.append(json.loads(line))
+        else:
+            rows = list(csv.DictReader(open(path)))
+        jobs = {}
+        for row in rows:
+            address = (row.get('address') or '').strip()
+            if not address:
+                continue
+            is_water = (row.get('type') or ('water' if water else 'city')).strip().lower() == 'water'
+            jobs.setdefault((normalize_address(address), is_water), (address, is_water))
+        return len(rows), jobs.values()
+
+    def resolve_countries(self, found):
+        names = {}
+        for geocoder, l in found:
+            if len(l) > 1:
+                names[l[-1][1]] = l[-1][0]
+        countries = Country.objects.in_bulk(names.keys())
+        Country.objects.bulk_create([Country(abbr=abbr, name=name) for abbr, name in names.items()
+                                     if abbr not in countries])
+        return Country.objects.in_bulk(names.keys())
+
+    def resolve_states(self, found, countries):
+        wanted = {}
+        for geocoder, l in found:
+            if len(l) > 2:
+                wanted[(l[-1][1], l[-2][0])] = l[-2][1]
+        existing = {}
+        for state in State.objects.filter(country__in=set(c for c, n in wanted)):
+            existing[(state.country_id, state.name)] = state
+        State.objects.bulk_create([State(country=countries[c], name=n, key=key[:100])
+                                   for (c, n), key in wanted.items() if (c, n) not in existing])
+        for state in State.objects.filter(country__in=set(c for c, n in wanted)):
+            existing[(state.country_id, state.name)] = state
+        return existing
+
+    def build(self, model, found, countries, states):
+        """
+        Builds the unsaved rows the same way BaseLocation.clean and WaterBody.clean do,
+        skipping coordinates that are already taken
+        """
+        taken = set()
+        for group in chunks(set(g.lat for g, l in found)):
+            taken.update(model.objects.filter(lat__in=group).values_list('lat', 'lng'))
+        if model is WaterBody:
+            names = set()
+            for group in chunks(set(l[0] for g, l in found)):
+                names.update(WaterBody.objects.filter(name__in=group).values_list('name', flat=True))
+        objs = []
+        for geocoder, l in found:
+            if (geocoder.lat, geocoder.lng) in taken or (model is BaseLocation and len(l) < 2):
+                continue
+            taken.add((geocoder.lat, geocoder.lng))
+            obj = model(lat=geocoder.lat, lng=geocoder.lng, json_response=geocoder.results)
+            if model is WaterBody:
+                if l[0] in names:
+                    continue
+                names.add(l[0])
+                obj.name = l[0]
+                obj.country = countries[l[-1][1]] if len(l) > 1 else None
+            else:
+                obj.city = l[0]
+                obj.country = countries[l[-1][1]]
+            obj.state = states.get((l[-1][1], l[-2][0])) if len(l) > 2 else None
+            objs.append(obj)
+        return objs
+
+    @transaction.commit_on_success
+    def insert(self, found, options):
+        countries = self.resolve_countries([f for w, f in found])
+        states = self.resolve_states([f for w, f in found], countries)
+        inserted = {}
+        for model, water in ((BaseLocation, False), (WaterBody, True)):
+            objs = self.build(model, [f for w, f in found if w == water], countries, states)
+            for group in chunks(objs):
+                model.objects.bulk_create(group)
+            spatial.invalidate(model)
+            inserted[model] = objs
+        return inserted
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give exactly one CSV or JSONL file")
+        start = time.time()
+        total, jobs = self.read(args[0], options['water'])
+        self.stdout.write("%d rows, %d distinct addresses\n" % (total, len(jobs)))
+        pool = ThreadPool(options['workers'])
+        found, failed = [], []
+        try:
+            for address, water, geocoder in pool.imap_unordered(geocode, jobs):
+                if geocoder is None:
+                    failed.append(address)
+                else:
+                    found.append((water, (geocoder, geocoder.parseLocation())))
+        finally:
+            pool.close()
+            pool.join()
+        geocoded = time.time()
+        self.stdout.write("Geocoded %d addresses in %.1f s (%.1f/s), %d failed\n" %
+                          (len(jobs), geocoded - start, len(jobs) / max(geocoded - start, 1e-6), len(failed)))
+        for address in failed:
+            self.stderr.write("Could not geocode: %s\n" % address)
+        inserted = self.insert(found, options)
+        self.stdout.write("Inserted %d locations and %d water bodies in %.1f s\n" %
+                          (len(inserted[BaseLocation]), len(inserted[WaterBody]), time.time() - geocoded))
+        if options['associate']:
+            # bulk_create sends no post_save, so the new rows are related to their surroundings here
+            linked = 0
+            for model, manager_link in ((BaseLocation, GeoRelations.custom.link_locations),
+                                        (WaterBody, GeoRelations.custom.link_waters)):
+                for group in chunks(inserted[model]):
+                    linked += manager_link(model.objects.filter(lat__in=[o.lat for o in group]).only('id'))
+            self.stdout.write("Added %d location and water body relations\n" % linked)
+        elapsed = time.time() - start
+        self.stdout.write("Done in %.1f s, %.1f addresses/s\n" % (elapsed, len(jobs) / max(elapsed, 1e-6)))
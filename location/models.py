@@ -5,7 +5,9 @@ from django.db import models, connection, transaction
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.conf import settings
 
-from myproject.custom import GoogleLatLng
+from myproject.custom import get_geocoder
+from myproject.location import spatial
+from myproject.location.geo import distance_sql, bounding_box_sql
 
 # Create your models here.
 
@@ -38,18 +40,36 @@ class State(models.Model):
         unique_together = ('country', 'name')
 
 class LocationManager(models.Manager):
-    def nearby_locations(self, latitude, longitude, radius, use_miles=False):
-        if use_miles:
-            distance_unit = 3959
-        else:
-            distance_unit = 6371
-        cursor = connection.cursor()
-        sql = """SELECT id, lat, lng FROM %s WHERE (%f * acos( cos( radians(%f) ) * cos( radians( lat ) ) *
-        cos( radians( lng ) - radians(%f) ) + sin( radians(%f) ) * sin( radians( lat ) ) ) ) < %d
-        """ % (self.model._meta.db_table, distance_unit, latitude, longitude, latitude, int(radius))
-        cursor.execute(sql)
-        ids = [row[0] for row in cursor.fetchall()]
-        return self.filter(id__in=ids)
+    def nearby_locations(self, latitude, longitude, radius, use_miles=False, prefilter=True, use_index=None):
+        """
+        Returns the rows within radius of (latitude, longitude), annotated with their distance.
+        With prefilter, a lat/lng bounding box is checked before the exact distance, so the database
+        can answer from the (lat, lng) unique index instead of running acos over the whole table.
+        The result is a lazy queryset, so it can be used as a subquery without fetching the ids.
+        With the in-memory index (settings.GEO_INDEX) the ids are found without querying the database.
+        """
+        distance, distance_params = distance_sql(latitude, longitude, use_miles)
+        if use_index is None:
+            use_index = spatial.enabled()
+        if use_index:
+            ids = spatial.get_index(self.model).nearby(latitude, longitude, radius, use_miles)
+            return self.filter(id__in=ids.keys()).extra(select={ 'distance':distance }, select_params=distance_params)
+        where = [distance + " < %s"]
+        params = distance_params + [int(radius)]
+        if prefilter:
+            box, box_params = bounding_box_sql(latitude, longitude, int(radius), use_miles)
+            where.insert(0, box)
+            params = box_params + params
+        return self.extra(select={ 'distance':distance }, select_params=distance_params,
+                          where=where, params=params)
+
+    def nearby_ids(self, latitude, longitude, radius, use_miles=False):
+        """
+        Returns a dict of id -> distance for the rows within radius of (latitude, longitude)
+        """
+        if spatial.enabled():
+            return spatial.get_index(self.model).nearby(latitude, longitude, radius, use_miles)
+        return dict(self.nearby_locations(latitude, longitude, radius, use_miles).values_list('id', 'distance'))
 
 class BaseLocation(models.Model):
     city = models.CharField(max_length=150)
@@ -69,7 +89,7 @@ class BaseLocation(models.Model):
         mquery = kwargs.get('mquery')
         if self.city or mquery:
             if not mquery:
-                mquery = GoogleLatLng()
+                mquery = get_geocoder()
                 state = self.state.name if self.state else ''
                 country = self.country.abbr if self.country else ''
                 if not mquery.requestLatLngJSON(self.city + ', ' + state + ', ' + country):
@@ -107,3 +127,5 @@ class BaseLocation(models.Model):
     class Meta:
         verbose_name = "Location of Operation"
         unique_together = ('lat', 'lng')
+
+spatial.register(BaseLocation)
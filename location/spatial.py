@@ -0,0 +1,174 @@
+import math
+import time
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from myproject.location.geo import bounding_box, earth_radius
+
+# In-process spatial index over the lat/lng columns of BaseLocation and WaterBody.
+# Enable with settings.GEO_INDEX = True; requires NumPy. Each process keeps its own copy, which is
+# built on first use, patched by the post_save/post_delete signals of that process and rebuilt
+# from the database once it is older than settings.GEO_INDEX_MAX_AGE seconds.
+
+CELL_SIZE = 1.0         # Grid cell size in degrees
+COMPACT_THRESHOLD = 500 # Pending changes kept on the side before the arrays are rebuilt
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def enabled():
+    return numpy is not None and getattr(settings, 'GEO_INDEX', False)
+
+def haversine(lat, lng, lats, lngs, use_miles=False):
+    """
+    Great-circle distance from (lat, lng) in degrees to arrays of latitudes and longitudes in radians
+    """
+    lat, lng = math.radians(lat), math.radians(lng)
+    a = numpy.sin((lats - lat) / 2) ** 2 + math.cos(lat) * numpy.cos(lats) * numpy.sin((lngs - lng) / 2) ** 2
+    return 2 * earth_radius(use_miles) * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+class GeoIndex(object):
+    """
+    Points are bucketed into CELL_SIZE degree cells and kept sorted by cell number, so every row of
+    cells in a bounding box is one contiguous slice of the arrays. Distances are only computed for
+    the points in those slices.
+    """
+    def __init__(self, model, cell_size=CELL_SIZE):
+        self.model = model
+        self.cell_size = cell_size
+        self.ncols = int(math.ceil(360.0 / cell_size))
+        self.lock = threading.RLock()
+        self.built_on = None
+        self.changed = {}
+        self.removed = set()
+
+    def cell(self, lat, lng):
+        row = numpy.floor((numpy.asarray(lat) + 90.0) / self.cell_size).astype(numpy.int64)
+        col = numpy.floor((numpy.asarray(lng) + 180.0) / self.cell_size).astype(numpy.int64)
+        return row * self.ncols + numpy.minimum(col, self.ncols - 1)
+
+    def load(self, points):
+        """
+        points is a sequence of (id, lat, lng) in degrees. Ungeocoded rows are left out.
+        """
+        points = [p for p in points if -90.0 <= p[1] <= 90.0 and -180.0 <= p[2] <= 180.0]
+        ids = numpy.array([p[0] for p in points], dtype=numpy.int64)
+        lats = numpy.array([p[1] for p in points], dtype=numpy.float64)
+        lngs = numpy.array([p[2] for p in points], dtype=numpy.float64)
+        cells = self.cell(lats, lngs)
+        order = numpy.argsort(cells, kind='mergesort')
+        with self.lock:
+            self.ids, self.cells = ids[order], cells[order]
+            self.lats, self.lngs = numpy.radians(lats[order]), numpy.radians(lngs[order])
+            self.changed, self.removed = {}, set()
+
+    def build(self):
+        self.load(self.model.objects.values_list('id', 'lat', 'lng').iterator())
+        self.built_on = time.time()
+
+    def is_stale(self):
+        max_age = getattr(settings, 'GEO_INDEX_MAX_AGE', 3600)
+        return self.built_on is None or (max_age and time.time() - self.built_on > max_age)
+
+    def update(self, id, lat, lng):
+        with self.lock:
+            self.removed.discard(id)
+            self.changed[id] = (lat, lng)
+            self.compact()
+
+    def remove(self, id):
+        with self.lock:
+            self.changed.pop(id, None)
+            self.removed.add(id)
+            self.compact()
+
+    def compact(self):
+        if len(self.changed) + len(self.removed) < COMPACT_THRESHOLD:
+            return
+        stale = self.removed.union(self.changed)
+        points = [(id, math.degrees(lat), math.degrees(lng))
+                  for id, lat, lng in zip(self.ids, self.lats, self.lngs) if id not in stale]
+        points.extend((id, lat, lng) for id, (lat, lng) in self.changed.items())
+        self.load(points)
+
+    def nearby(self, latitude, longitude, radius, use_miles=False):
+        """
+        Returns a dict of id -> distance for the points closer than radius, matching the
+        `distance < int(radius)` test of LocationManager.nearby_locations.
+        """
+        radius = int(radius)
+        min_lat, max_lat, lng_ranges = bounding_box(latitude, longitude, radius, use_miles)
+        with self.lock:
+            ids, cells, lats, lngs = self.ids, self.cells, self.lats, self.lngs
+            changed, removed = dict(self.changed), set(self.removed)
+        first_row = int(math.floor((max(min_lat, -90.0) + 90.0) / self.cell_size))
+        last_row = int(math.floor((min(max_lat, 90.0) + 90.0) / self.cell_size))
+        slices = []
+        for row in xrange(first_row, last_row + 1):
+            for min_lng, max_lng in lng_ranges:
+                first = row * self.ncols + int(math.floor((min_lng + 180.0) / self.cell_size))
+                last = row * self.ncols + min(int(math.floor((max_lng + 180.0) / self.cell_size)), self.ncols - 1)
+                start, end = numpy.searchsorted(cells, [first, last + 1])
+                if end > start:
+                    slices.append(numpy.arange(start, end))
+        result = {}
+        if slices:
+            candidates = numpy.concatenate(slices)
+            distances = haversine(latitude, longitude, lats[candidates], lngs[candidates], use_miles)
+            hits = distances < radius
+            for id, distance in zip(ids[candidates][hits].tolist(), distances[hits].tolist()):
+                if id not in removed and id not in changed:
+                    result[id] = distance
+        if changed:
+            extra = changed.items()
+            distances = haversine(latitude, longitude, numpy.radians([p[1][0] for p in extra]),
+                                  numpy.radians([p[1][1] for p in extra]), use_miles)
+            for (id, point), distance in zip(extra, distances.tolist()):
+                if distance < radius:
+                    result[id] = distance
+        return result
+
+def get_index(model):
+    with _indexes_lock:
+        index = _indexes.get(model)
+        if index is None:
+            index = _indexes[model] = GeoIndex(model)
+    with index.lock:
+        if index.is_stale():
+            index.build()
+    return index
+
+def invalidate(model):
+    """
+    Forces a rebuild on the next search, e.g. after rows were inserted with bulk_create
+    """
+    index = _indexes.get(model)
+    if index is not None:
+        index.built_on = None
+
+def location_saved(sender, instance=None, **kwargs):
+    index = _indexes.get(sender)
+    if index is not None and instance is not None and index.built_on is not None:
+        if -90.0 <= instance.lat <= 90.0 and -180.0 <= instance.lng <= 180.0:
+            index.update(instance.id, instance.lat, instance.lng)
+        else:
+            index.remove(instance.id)
+
+def location_deleted(sender, instance=None, **kwargs):
+    index = _indexes.get(sender)
+    if index is not None and instance is not None and index.built_on is not None:
+        index.remove(instance.id)
+
+def register(model):
+    """
+    Keeps the index of model in step with its saves and deletes
+    """
+    post_save.connect(location_saved, sender=model, dispatch_uid='geoindex_save_%s' % model.__name__)
+    post_delete.connect(location_deleted, sender=model, dispatch_uid='geoindex_delete_%s' % model.__name__)
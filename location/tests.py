@@ -5,8 +5,17 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import tempfile
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
 from django.test import TestCase
 
+from myproject.custom import Gazetteer, GazetteerGeocoder, GoogleLatLng
+from myproject.location.models import BaseLocation
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +23,113 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class NearbyTest(TestCase):
+    def test_own_coordinates(self):
+        """
+        A search from the coordinates of a location finds it, even where the acos argument rounds past 1
+        """
+        # save() would geocode the city
+        BaseLocation.objects.bulk_create([BaseLocation(city='Here', lat=-4.883558489858693, lng=129.98693100696806),
+                                          BaseLocation(city='There', lat=-4.5, lng=130.0)])
+        here = BaseLocation.objects.get(city='Here')
+        for prefilter in (False, True):
+            near = BaseLocation.neighbours.nearby_locations(here.lat, here.lng, 100, True, prefilter=prefilter, use_index=False)
+            self.assertEqual(sorted(near.values_list('city', flat=True)), ['Here', 'There'])
+
+GEONAMES_ROWS = [
+    ['4671654', 'Austin', 'Austin', '', '30.26715', '-97.74306', 'P', 'PPLA', 'US', '', 'TX', '453', '', '', '931830'],
+    ['5520993', 'El Paso', 'El Paso', '', '31.75872', '-106.48693', 'P', 'PPLA2', 'US', '', 'TX', '141', '', '', '649121'],
+    ['4736286', 'Texas', 'Texas', '', '31.25044', '-99.25061', 'A', 'ADM1', 'US', '', 'TX', '', '', '', '22875689'],
+    ['4736390', 'Lake Travis', 'Lake Travis', '', '30.42', '-97.91', 'H', 'RSV', 'US', '', 'TX', '453', '', '', '0'],
+    ['4671655', 'Austin', 'Austin', '', '43.66663', '-92.97464', 'P', 'PPLA2', 'US', '', 'MN', '099', '', '', '24718'],
+]
+
+class GazetteerTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, '\n'.join('\t'.join(row + ['0', '0', 'America/Chicago', '2012-01-01']) for row in GEONAMES_ROWS))
+        os.close(fd)
+        fd, self.admin1_path = tempfile.mkstemp()
+        os.write(fd, 'US.TX\tTexas\tTexas\t4736286\nUS.MN\tMinnesota\tMinnesota\t5037779\n')
+        os.close(fd)
+        self.gazetteer = Gazetteer(self.path, self.admin1_path)
+
+    def tearDown(self):
+        os.remove(self.path)
+        os.remove(self.admin1_path)
+
+    def test_qualifiers(self):
+        """
+        The most populous match wins unless the state or country narrows it down
+        """
+        self.assertEqual(self.gazetteer.search('austin')[0]['geometry']['location']['lat'], 30.26715)
+        result = self.gazetteer.search('Austin, Minnesota, US')[0]
+        self.assertEqual(result['geometry']['location']['lat'], 43.66663)
+        self.assertEqual(self.gazetteer.search('Austin, CA'), [])
+
+    def test_parse_location(self):
+        geocoder = GazetteerGeocoder()
+        geocoder.fetch = lambda address, **kwargs: { 'results':self.gazetteer.search(address) }
+        self.assertTrue(geocoder.requestLatLngJSON('Austin, TX, US'))
+        self.assertEqual(geocoder.parseLocation(), [u'Austin', (u'Texas', u'TX'), (u'United States', u'US')])
+        self.assertTrue(geocoder.requestLatLngJSON('Lake Travis', True))
+        self.assertEqual(geocoder.parseLocation()[0], u'Lake Travis')
+        self.assertTrue(geocoder.requestLatLngJSON('Texas'))
+        self.assertEqual(geocoder.results['address_components'][0]['short_name'], u'TX')
+
+class GeocoderHandler(BaseHTTPRequestHandler):
+    """
+    Answers like the Geocoder API for 'Austin', and with the errors that proxies and outages produce for
+    the other addresses
+    """
+    ANSWERS = {
+        'austin': (200, '{"status": "OK", "results": [{"types": ["locality"], "address_components": [], '
+                        '"geometry": {"location": {"lat": 30.27, "lng": -97.74}}}]}'),
+        'forbidden': (403, '<html><body>Forbidden</body></html>'),
+        'html': (200, '<html><body>Try again later</body></html>'),
+        'list': (200, '[]'),
+        'outage': (503, '<html><body>Unavailable</body></html>'),
+    }
+
+    def do_GET(self):
+        address = urlparse.parse_qs(urlparse.urlsplit(self.path).query)['address'][0]
+        status, body = self.ANSWERS[address]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class GoogleLatLngTest(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), GeocoderHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def geocoder(self):
+        geocoder = GoogleLatLng()
+        geocoder.GEOCODE_URL = 'http://127.0.0.1:%d/maps/api/geocode/json' % self.server.server_address[1]
+        return geocoder
+
+    def test_answer(self):
+        geocoder = self.geocoder()
+        self.assertTrue(geocoder.requestLatLngJSON('austin'))
+        self.assertEqual((geocoder.lat, geocoder.lng), (30.27, -97.74))
+
+    def test_error_pages(self):
+        """
+        Error statuses and bodies that are not Geocoder JSON count as a failed lookup instead of raising
+        """
+        with self.settings(GEOCODE_RETRIES=0):
+            for address in ('forbidden', 'html', 'list', 'outage'):
+                geocoder = self.geocoder()
+                self.assertFalse(geocoder.requestLatLngJSON(address), address)
+                self.assertEqual(geocoder.results['status'], 'UNKNOWN_ERROR')
@@ -0,0 +1,26 @@
+import heapq
+
+from django.core.management.base import BaseCommand
+
+from myproject.tdetails.models import Trip
+
+class Command(BaseCommand):
+    help = "Lists the pairs of trips of the same guide that overlap in time"
+
+    def handle(self, *args, **options):
+        """
+        One sweep over the trips ordered by guide and start, keeping a heap of the trips still running
+        at the current start, so the cost is O(n log n) plus the number of overlaps found
+        """
+        guide, running, count = None, [], 0
+        trips = Trip.objects.order_by('guide', 'trip_start_date', 'id').values_list('guide', 'id', 'trip_start_date', 'trip_end_date')
+        for trip_guide, id, start, end in trips.iterator():
+            if trip_guide != guide:
+                guide, running = trip_guide, []
+            while running and running[0][0] <= start:
+                heapq.heappop(running)
+            for other_end, other in running:
+                self.stdout.write("Guide %d: trip %d overlaps trip %d\n" % (guide, other, id))
+                count += 1
+            heapq.heappush(running, (end, id))
+        self.stdout.write("Found %d overlapping pairs of trips\n" % count)
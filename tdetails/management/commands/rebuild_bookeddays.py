@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject.fishing import searchcache
+from myproject.tdetails.models import BookedDay
+
+class Command(BaseCommand):
+    help = "Rebuilds the BookedDay rows of every guide from their trips and blackouts, which date searches read"
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        start = time.time()
+        count = BookedDay.objects.refresh()
+        searchcache.invalidate()
+        self.stdout.write("Rebuilt %d booked days in %.1f s\n" % (count, time.time() - start))
@@ -1,6 +1,9 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
 from django.db import models
 from django.db.models import F, Max, Count
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from django.template.defaultfilters import slugify
@@ -8,6 +11,7 @@ from django.template.defaultfilters import slugify
 from myproject.customer.models import CustomerCore
 from myproject.gprofile.models import GuideCore
 from myproject.location.models import BaseLocation
+from myproject.fishing import searchcache
 
 # Create your models here.
 
@@ -40,6 +44,23 @@ class Referral(models.Model):
         self.is_accepted = True
         self.save(force_update=True)
 
+def max_trip_length():
+    """
+    The longest trip, as a timedelta, from settings.MAX_TRIP_LENGTH in days
+    """
+    return timedelta(getattr(settings, 'MAX_TRIP_LENGTH', 30))
+
+class TripManager(models.Manager):
+    def overlapping(self, guide, start, end):
+        """
+        Trips of guide that share some time with the range from start to end. A trip may start when
+        the previous one ends. No trip is longer than max_trip_length(), so the trips that can overlap
+        start in a bounded range, which the (guide, trip_start_date) index of sql/trip.sql reads
+        without going through the other trips of the guide.
+        """
+        return self.filter(guide=guide, trip_start_date__gt=start - max_trip_length(), trip_start_date__lt=end,
+                           trip_end_date__gt=start)
+
 class Trip(models.Model):
     customer = models.ForeignKey(CustomerCore, related_name='Adventure')
     guide = models.ForeignKey(GuideCore, related_name='Tours')
@@ -52,6 +73,8 @@ class Trip(models.Model):
     is_reviewed = models.BooleanField(default=False, blank=True, editable=False)
     rand_id = models.SlugField(editable=False, default=None, unique=True)
 
+    objects = TripManager()
+
     class Meta:
         ordering = ['-trip_start_date']
         unique_together = ('customer', 'guide', 'trip_start_date', 'trip_end_date')
@@ -62,8 +85,16 @@ class Trip(models.Model):
     def clean(self):
         if self.trip_end_date < self.trip_start_date:
             raise ValidationError("Start Date cannot be after the End Date")
+        if self.trip_end_date - self.trip_start_date > max_trip_length():
+            raise ValidationError("A trip cannot be longer than %d days" % max_trip_length().days)
         if self.num_people < 1:
             raise ValidationError("The number of people cannot be less than 1")
+        if self.guide_id:
+            if Trip.objects.overlapping(self.guide_id, self.trip_start_date, self.trip_end_date).exclude(pk=self.pk).exists():
+                raise ValidationError("The guide already has a trip at that time")
+            if GuideBlackout.objects.filter(guide=self.guide_id, start_date__lte=_day(self.trip_end_date),
+                                            end_date__gte=_day(self.trip_start_date)).exists():
+                raise ValidationError("The guide is not available on those dates")
 
     def save(self, *args, **kwargs):
         if not self.rand_id:
@@ -85,6 +116,79 @@ class Trip(models.Model):
         self.paid = True
         self.save(force_update=True)
 
+class GuideBlackout(models.Model):
+    guide = models.ForeignKey(GuideCore, related_name='Blackouts')
+    start_date = models.DateField()
+    end_date = models.DateField()
+    reason = models.CharField(max_length=200, blank=True, default='')
+
+    class Meta:
+        verbose_name = "Guide Blackout"
+        ordering = ['guide', 'start_date']
+
+    def __unicode__(self):
+        return '%s unavailable from %s to %s' % (self.guide.person.full_name, self.start_date.strftime('%d-%m-%Y'), self.end_date.strftime('%d-%m-%Y'))
+
+    def clean(self):
+        if self.end_date < self.start_date:
+            raise ValidationError("Start Date cannot be after the End Date")
+
+def _day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+class BookedDayManager(models.Manager):
+    def refresh(self, ids=None):
+        """
+        Recomputes the booked days of the guides with the given ids, or of every guide when ids is None,
+        from their trips and blackouts. Returns the number of days written.
+        """
+        if ids is None:
+            ids = GuideCore.objects.values_list('id', flat=True)
+        ids = list(ids)
+        count = 0
+        for offset in xrange(0, len(ids), 500):
+            count += self._refresh(ids[offset:offset+500])
+        return count
+
+    def _refresh(self, ids):
+        # Trips and blackouts deleted along with their guide are signalled after the guide is gone
+        ids = list(GuideCore.objects.filter(id__in=ids).values_list('id', flat=True))
+        days = set()
+        ranges = list(Trip.objects.filter(guide__in=ids).values_list('guide', 'trip_start_date', 'trip_end_date'))
+        ranges.extend(GuideBlackout.objects.filter(guide__in=ids).values_list('guide', 'start_date', 'end_date'))
+        for guide, start, end in ranges:
+            day, end = _day(start), _day(end)
+            while day <= end:
+                days.add((guide, day))
+                day += timedelta(1)
+        self.filter(guide__in=ids).delete()
+        rows = [self.model(guide_id=guide, day=day) for guide, day in sorted(days)]
+        for offset in xrange(0, len(rows), 500):
+            self.bulk_create(rows[offset:offset+500])
+        return len(rows)
+
+    def booked(self, day):
+        """
+        The ids of the guides that are booked or blacked out on day, as a subquery
+        """
+        return self.filter(day=_day(day)).values('guide')
+
+class BookedDay(models.Model):
+    """
+    One row per guide and day on which the guide has a trip or a blackout, so that the guides that are
+    unavailable on a day are read from the (day, guide) index instead of from the trip ranges
+    """
+    guide = models.ForeignKey(GuideCore, related_name='BookedDays')
+    day = models.DateField()
+
+    objects = BookedDayManager()
+
+    class Meta:
+        unique_together = ('day', 'guide')
+
+    def __unicode__(self):
+        return '%s booked on %s' % (self.guide_id, self.day.strftime('%d-%m-%Y'))
+
 class BaseReview(models.Model):
     comment = models.CharField(max_length=3000)
     submit_date = models.DateField(auto_now_add=True)
@@ -165,10 +269,28 @@ class GuideRecommend(BaseReview):
 @receiver(post_save, sender=Trip)
 def update_profile(sender, created=False, instance=None, **kwargs):
     if created and instance:
-        dict = obj.customer.Adventure.aggregate(num=Count('id'), date=Max('trip_end_date'))
-        obj.customer.profile.ntrips = dict['num']
+        customer = instance.customer
+        dict = customer.Adventure.aggregate(num=Count('id'), date=Max('trip_end_date'))
+        customer.profile.ntrips = dict['num']
         try:
-            obj.customer.profile.last_trip = Trip.objects.get(customer=obj, trip_end_date=dict['date'])
+            customer.profile.last_trip = Trip.objects.get(customer=customer, trip_end_date=dict['date'])
         except:
-            obj.customer.profile.last_trip = None
-        obj.customer.profile.save(force_update=True)
+            customer.profile.last_trip = None
+        customer.profile.save(force_update=True)
+
+@receiver(pre_save, sender=Trip)
+@receiver(pre_save, sender=GuideBlackout)
+def remember_guide(sender, instance=None, raw=False, **kwargs):
+    if instance and not raw and instance.pk:
+        instance._saved_guide_ids = list(sender.objects.filter(pk=instance.pk).values_list('guide', flat=True))
+
+@receiver(post_save, sender=Trip)
+@receiver(post_delete, sender=Trip)
+@receiver(post_save, sender=GuideBlackout)
+@receiver(post_delete, sender=GuideBlackout)
+def refresh_booked_days(sender, instance=None, raw=False, **kwargs):
+    # A trip or blackout moved to another guide frees the days of the guide it had before
+    if instance is not None and not raw:
+        BookedDay.objects.refresh(set([instance.guide_id] + getattr(instance, '_saved_guide_ids', [])))
+
+searchcache.connect(Trip, GuideBlackout)
@@ -0,0 +1,2 @@
+-- Trip.clean looks for overlapping trips by guide and start date (see TripManager.overlapping)
+CREATE INDEX tdetails_trip_guide_start ON tdetails_trip (guide_id, trip_start_date);
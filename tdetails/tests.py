@@ -5,8 +5,19 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from datetime import date, datetime, timedelta
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.test import TestCase
 
+from myproject.customer.models import ContactInfo, CustomerCore
+from myproject.gprofile.models import GuideCore
+from myproject.location.models import BaseLocation, Country, State
+from myproject.tdetails.models import GuideBlackout, Trip
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +25,72 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class TripOverlapTest(TestCase):
+    def setUp(self):
+        country = Country.objects.create(abbr='US', name='United States')
+        state = State.objects.create(country=country, name='Texas', key='TX')
+        BaseLocation.objects.bulk_create([BaseLocation(city='Austin', state=state, country=country, lat=30.27, lng=-97.74)])
+        self.location = BaseLocation.objects.get()
+        self.guides = []
+        for i in range(2):
+            user = User.objects.create(username='guide%d' % i, email='guide%d@example.com' % i)
+            person = CustomerCore.objects.get(user=user)
+            ContactInfo.objects.filter(id=person.contact_id).update(city='Austin', state=state, country=country)
+            guide = GuideCore(person=CustomerCore.objects.get(id=person.id))
+            guide.save()
+            self.guides.append(guide)
+        self.customer = CustomerCore.objects.get(user=User.objects.create(username='angler', email='angler@example.com'))
+        self.start = datetime(2030, 6, 10, 8)
+        self.trip(self.guides[0], self.start, self.start + timedelta(hours=8)).save()
+
+    def trip(self, guide, start, end):
+        return Trip(customer=self.customer, guide=guide, location=self.location, num_people=2,
+                    trip_start_date=start, trip_end_date=end)
+
+    def test_overlapping_trip(self):
+        for hours in ((-2, 1), (4, 6), (7, 12), (-1, 9)):
+            trip = self.trip(self.guides[0], self.start + timedelta(hours=hours[0]), self.start + timedelta(hours=hours[1]))
+            self.assertRaises(ValidationError, trip.clean)
+        self.trip(self.guides[1], self.start, self.start + timedelta(hours=8)).clean()
+
+    def test_back_to_back_trips(self):
+        self.trip(self.guides[0], self.start + timedelta(hours=8), self.start + timedelta(hours=10)).clean()
+        self.trip(self.guides[0], self.start - timedelta(hours=2), self.start).clean()
+
+    def test_long_trips(self):
+        self.trip(self.guides[0], self.start - timedelta(29), self.start).clean()
+        with self.settings(MAX_TRIP_LENGTH=30):
+            self.assertRaises(ValidationError, self.trip(self.guides[1], self.start, self.start + timedelta(31)).clean)
+        with self.settings(MAX_TRIP_LENGTH=2):
+            self.assertRaises(ValidationError, self.trip(self.guides[1], self.start, self.start + timedelta(3)).clean)
+            # Trips are at most two days long, so a trip starting three days earlier cannot overlap
+            self.assertFalse(Trip.objects.overlapping(self.guides[0], self.start + timedelta(3),
+                                                      self.start + timedelta(4)).exists())
+
+    def test_blackout(self):
+        GuideBlackout.objects.create(guide=self.guides[1], start_date=date(2030, 6, 12), end_date=date(2030, 6, 13))
+        for day in (11, 12, 13):
+            trip = self.trip(self.guides[1], datetime(2030, 6, day, 20), datetime(2030, 6, day + 1, 4))
+            self.assertRaises(ValidationError, trip.clean)
+        self.trip(self.guides[1], datetime(2030, 6, 14, 8), datetime(2030, 6, 14, 16)).clean()
+        self.trip(self.guides[0], datetime(2030, 6, 12, 8), datetime(2030, 6, 12, 16)).clean()
+
+    def test_find_overlapping_trips(self):
+        guide = self.guides[0]
+        first = Trip.objects.get()
+        # Saved in bulk, past the checks of clean()
+        trips = [self.trip(guide, self.start + timedelta(hours=4), self.start + timedelta(hours=9)),
+                 self.trip(guide, self.start + timedelta(hours=8), self.start + timedelta(hours=12)),
+                 self.trip(self.guides[1], self.start, self.start + timedelta(hours=8))]
+        for i, trip in enumerate(trips):
+            trip.rand_id = 'bulk-%d' % i
+        Trip.objects.bulk_create(trips)
+        second = Trip.objects.get(trip_start_date=self.start + timedelta(hours=4))
+        third = Trip.objects.get(guide=guide, trip_start_date=self.start + timedelta(hours=8))
+        out = StringIO()
+        call_command('find_overlapping_trips', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(sorted(lines[:-1]), sorted(["Guide %d: trip %d overlaps trip %d" % (guide.id, first.id, second.id),
+                                                     "Guide %d: trip %d overlaps trip %d" % (guide.id, second.id, third.id)]))
+        self.assertEqual(lines[-1], "Found 2 overlapping pairs of trips")